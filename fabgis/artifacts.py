@@ -0,0 +1,162 @@
+# coding=utf-8
+"""
+Binary artifact cache.
+======================
+
+Tools for reusing the install prefix of a source build on other hosts.
+After a build the prefix is packed into a compressed tarball named after a
+content key - a hash of everything that determines the binaries, such as
+the source commit, build flags, OS release and dependency versions. Before
+building, a host with the same key unpacks the tarball instead.
+
+Artifacts are kept in a store which is either a directory on the control
+host (the default, ``fabgis_resources/artifacts``) or a directory on a
+fleet store host given as ``[user@]host:/path``. Transfers to and from a
+store host are relayed through the control host.
+
+"""
+import os
+import hashlib
+from fabric.api import run, sudo, get, put, fastprint, settings, hide, env
+from fabric.colors import green, blue
+from fabric.contrib.files import exists
+from .common import setup_env
+
+LOCAL_ARTIFACT_STORE = os.path.join('fabgis_resources', 'artifacts')
+
+
+def artifact_key(*parts):
+    """Get the content key for an artifact from the facts that define it.
+
+    :param parts: Strings that together determine the build output e.g.
+        source commit, build flags and dependency versions.
+    :type parts: str
+
+    :returns: Hex sha256 digest of the parts.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).strip())
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def get_build_facts(packages):
+    """Get the OS release and installed versions of packages on the host.
+
+    :param packages: Names of the deb packages whose versions matter.
+    :type packages: list
+
+    :returns: The facts as one string, suitable for :func:`artifact_key`.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    with settings(warn_only=True), hide('output', 'warnings'):
+        facts = run(
+            'lsb_release -ds; uname -m; '
+            'dpkg-query -W -f "${Package}=${Version}\\n" %s 2> /dev/null; '
+            'test -x /usr/local/bin/gdal-config && '
+            '/usr/local/bin/gdal-config --version' % ' '.join(packages))
+    return facts
+
+
+def _split_store(store):
+    """Split a store into its host (None for the control host) and path."""
+    if store is None:
+        return None, LOCAL_ARTIFACT_STORE
+    if ':' not in store:
+        return None, store
+    host, path = store.rsplit(':', 1)
+    return host, path
+
+
+def fetch_artifact(name, key, prefix, store=None):
+    """Unpack a cached artifact into an install prefix if there is one.
+
+    :param name: Name of the project e.g. 'qgis'.
+    :type name: str
+
+    :param key: Content key from :func:`artifact_key`.
+    :type key: str
+
+    :param prefix: Install prefix on the remote host to unpack into. Any
+        existing content is replaced and the prefix is owned by the fabgis
+        user, as after a source build.
+    :type prefix: str
+
+    :param store: Artifact store - see the module documentation.
+    :type store: str
+
+    :returns: True if the artifact was found and unpacked, False on a miss.
+    :rtype: bool
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    filename = '%s-%s.tar.gz' % (name, key)
+    host, path = _split_store(store)
+    if host is None:
+        local_file = os.path.join(path, filename)
+        found = os.path.exists(local_file)
+    else:
+        local_file = os.path.join(LOCAL_ARTIFACT_STORE, filename)
+        with settings(host_string=host):
+            found = exists(os.path.join(path, filename))
+            if found:
+                if not os.path.exists(LOCAL_ARTIFACT_STORE):
+                    os.makedirs(LOCAL_ARTIFACT_STORE)
+                get(os.path.join(path, filename), local_file)
+    if not found:
+        fastprint(blue('No %s artifact for %s, building.\n' % (name, key)))
+        return False
+
+    fastprint(green('Installing cached %s artifact %s\n' % (name, key)))
+    remote_file = '/tmp/%s' % filename
+    put(local_file, remote_file)
+    sudo('rm -rf %s' % prefix)
+    sudo('mkdir -p %s' % prefix)
+    sudo('tar xzf %s -C %s --no-same-owner' % (remote_file, prefix))
+    sudo('chown -R %s %s' % (env.fg.user, prefix))
+    run('rm %s' % remote_file)
+    if host is not None:
+        os.remove(local_file)
+    return True
+
+
+def store_artifact(name, key, prefix, store=None):
+    """Pack an install prefix and save it in the artifact store.
+
+    :param name: Name of the project e.g. 'qgis'.
+    :type name: str
+
+    :param key: Content key from :func:`artifact_key`.
+    :type key: str
+
+    :param prefix: Install prefix on the remote host to pack.
+    :type prefix: str
+
+    :param store: Artifact store - see the module documentation.
+    :type store: str
+
+    .. versionadded:: 0.18.0
+    """
+    filename = '%s-%s.tar.gz' % (name, key)
+    remote_file = '/tmp/%s' % filename
+    run('tar czf %s -C %s .' % (remote_file, prefix))
+    host, path = _split_store(store)
+    local_path = path if host is None else LOCAL_ARTIFACT_STORE
+    if not os.path.exists(local_path):
+        os.makedirs(local_path)
+    local_file = os.path.join(local_path, filename)
+    get(remote_file, local_file)
+    run('rm %s' % remote_file)
+    if host is not None:
+        with settings(host_string=host):
+            run('mkdir -p %s' % path)
+            put(local_file, os.path.join(path, filename))
+        os.remove(local_file)
+    fastprint(green('Stored %s artifact %s\n' % (name, key)))
@@ -0,0 +1,202 @@
+# coding=utf-8
+"""
+Fleet shared compiler cache.
+============================
+
+Tasks for sharing one compiler cache between many build hosts. One host
+runs the cache server - either an apache WebDAV share that ccache talks to
+over http or an NFS export - and each build host is configured to use it as
+ccache remote storage in addition to its local cache (see
+:func:`fabgis.system.setup_ccache`).
+
+Because the setting is part of the ccache environment it is used by every
+fabgis source build: compile_qgis, build_gdal, build_proj4 and build_hdf5.
+
+.. note:: Remote storage needs ccache 4.4 or newer on the build hosts.
+
+"""
+import os
+from StringIO import StringIO
+from fabric.api import task, run, sudo, fastprint, env, put, hide
+from fabric.colors import green, blue
+from fabric.contrib.files import upload_template
+from fabtools import require
+from .common import setup_env
+from .system import get_ccache_stats
+from .utilities import append_if_not_present
+
+CCACHE_REMOTE_PROFILE = '/etc/profile.d/fabgis-ccache-remote.sh'
+
+
+def get_ccache_version():
+    """Get the version of ccache installed on the remote host.
+
+    :returns: Version as a tuple of ints e.g. (4, 6).
+    :rtype: tuple
+    """
+    with hide('output'):
+        version = run('ccache --version | head -1')
+    version = version.strip().split(' ')[-1]
+    return tuple([int(part) for part in version.split('.') if part.isdigit()])
+
+
+@task
+def setup_ccache_server(
+        backend='http',
+        cache_root='/var/cache/ccache-shared',
+        port=8080,
+        allowed_network='10.0.0.0/8',
+        server_admin='none@none.com'):
+    """Set up a host to serve a compiler cache shared by the build fleet.
+
+    :param backend: 'http' to serve the cache with apache WebDAV or 'nfs' to
+        export it over NFS. Default 'http'.
+    :type backend: str
+
+    :param cache_root: Directory holding the shared cache.
+    :type cache_root: str
+
+    :param port: Port apache listens on for the http backend. Default 8080.
+    :type port: int
+
+    :param allowed_network: Network (CIDR) of the build hosts allowed to
+        read and write the cache.
+    :type allowed_network: str
+
+    :param server_admin: Email address for the server admin, placed in the
+        apache config file.
+    :type server_admin: str
+
+    To run e.g.::
+
+        fab -H cachehost setup_ccache_server:allowed_network=192.168.1.0/24
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    if backend == 'http':
+        require.deb.package('apache2')
+        require.directory(cache_root, use_sudo=True, owner='www-data')
+        template_path = os.path.join(
+            os.path.dirname(__file__),
+            'fabgis_resources', 'server_config', 'apache',
+            'fabgis.ccache.conf.templ')
+        context = {
+            'port': port,
+            'cache_root': cache_root,
+            'allowed_network': allowed_network,
+            'server_admin': server_admin}
+        upload_template(
+            template_path,
+            '/etc/apache2/sites-available/fabgis-ccache.conf',
+            context=context,
+            use_sudo=True)
+        sudo('a2enmod dav dav_fs')
+        sudo('a2ensite fabgis-ccache.conf')
+        # Check if apache configs are ok - script will abort if not ok
+        sudo('/usr/sbin/apache2ctl configtest')
+        require.service.restarted('apache2')
+        fastprint(green('Shared ccache served at http://%s:%s/ccache\n' % (
+            env.fg.hostname, port)))
+    elif backend == 'nfs':
+        require.deb.package('nfs-kernel-server')
+        require.directory(cache_root, use_sudo=True, owner='nobody')
+        sudo('chmod 1777 %s' % cache_root)
+        append_if_not_present(
+            '/etc/exports',
+            '%s %s(rw,sync,no_subtree_check,all_squash)' % (
+                cache_root, allowed_network),
+            use_sudo=True)
+        sudo('exportfs -ra')
+        fastprint(green('Shared ccache exported as %s:%s\n' % (
+            env.fg.hostname, cache_root)))
+    else:
+        raise Exception('Unknown ccache server backend: %s' % backend)
+
+
+@task
+def setup_remote_ccache(
+        server,
+        backend='http',
+        port=8080,
+        cache_root='/var/cache/ccache-shared',
+        mount_point='/mnt/ccache-shared'):
+    """Configure a build host to use a shared compiler cache server.
+
+    :param server: Host name or ip of the host set up with
+        :func:`setup_ccache_server`.
+    :type server: str
+
+    :param backend: 'http' or 'nfs' - must match the server. Default 'http'.
+    :type backend: str
+
+    :param port: Port of the http backend. Default 8080.
+    :type port: int
+
+    :param cache_root: Exported directory on the server for the nfs backend.
+    :type cache_root: str
+
+    :param mount_point: Where the nfs export is mounted on the build host.
+    :type mount_point: str
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    require.deb.package('ccache')
+    version = get_ccache_version()
+    if version < (4, 4):
+        raise Exception(
+            'ccache %s does not support remote storage, 4.4 or newer is '
+            'needed' % '.'.join([str(part) for part in version]))
+
+    if backend == 'http':
+        # Apache WebDAV will not create parent collections on PUT
+        url = 'http://%s:%s/ccache|layout=flat' % (server, port)
+    elif backend == 'nfs':
+        require.deb.package('nfs-common')
+        require.directory(mount_point, use_sudo=True)
+        append_if_not_present(
+            '/etc/fstab',
+            '%s:%s %s nfs defaults,soft,noatime 0 0' % (
+                server, cache_root, mount_point),
+            use_sudo=True)
+        sudo('mount %s || true' % mount_point)
+        url = 'file:%s' % mount_point
+    else:
+        raise Exception('Unknown ccache server backend: %s' % backend)
+
+    # ccache 4.4 - 4.7 call it secondary storage, later versions remote
+    settings_file = (
+        'export CCACHE_REMOTE_STORAGE="%(url)s"\n'
+        'export CCACHE_SECONDARY_STORAGE="%(url)s"\n' % {'url': url})
+    put(StringIO(settings_file),
+        CCACHE_REMOTE_PROFILE,
+        use_sudo=True,
+        mode=0o644)
+    fastprint(green('ccache remote storage set to %s\n' % url))
+
+
+@task
+def ccache_remote_report():
+    """Report how often builds on this host hit the fleet shared cache.
+
+    Run it against every build host to compare them e.g.::
+
+        fab -H build1,build2,build3 ccache_remote_report
+
+    :returns: Remote hit rate as a percentage of local cache misses.
+    :rtype: float
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    stats = get_ccache_stats()
+    hits = stats.get('remote_hits', 0)
+    misses = stats.get('remote_misses', 0)
+    if hits + misses:
+        rate = 100.0 * hits / (hits + misses)
+    else:
+        rate = 0.0
+    fastprint(blue('%s: %s remote hits, %s remote misses (%.1f%%)\n' % (
+        env.fg.hostname, hits, misses, rate)))
+    return rate
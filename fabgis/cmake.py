@@ -0,0 +1,141 @@
+# coding=utf-8
+"""
+Helpers for cmake based builds.
+===============================
+
+Shared by the source builds fabgis drives with cmake so that they can all
+switch generator (make or ninja) and opt in to precompiled headers and unity
+builds in the same way.
+
+"""
+from fabric.api import run, fastprint, hide, settings
+from fabric.colors import red
+import fabtools
+
+GENERATORS = {
+    'make': 'Unix Makefiles',
+    'ninja': 'Ninja',
+}
+
+
+def require_cmake_generator(generator='make'):
+    """Install the build tool needed by a cmake generator.
+
+    :param generator: Either 'make' or 'ninja'.
+    :type generator: str
+
+    .. versionadded:: 0.18.0
+    """
+    if generator not in GENERATORS:
+        raise Exception('Unknown cmake generator: %s' % generator)
+    fabtools.require.deb.package('cmake')
+    if generator == 'ninja':
+        fabtools.require.deb.package('ninja-build')
+
+
+def get_cmake_version():
+    """Get the version of cmake installed on the remote host.
+
+    :returns: Version as a tuple of ints e.g. (2, 8, 12).
+    :rtype: tuple
+    """
+    with hide('output'):
+        version = run('cmake --version | head -1')
+    version = version.strip().split(' ')[-1].split('-')[0]
+    return tuple([int(part) for part in version.split('.') if part.isdigit()])
+
+
+def _find_cmake_options(source_path, keywords):
+    """Find boolean options in a cmake project that mention a keyword.
+
+    :returns: Names of the matching options.
+    :rtype: list
+    """
+    pattern = '|'.join(keywords)
+    with settings(warn_only=True), hide('output', 'warnings'):
+        result = run(
+            'grep -ohiE "option *\\( *[A-Z_]*(%s)[A-Z_]*" '
+            '%s/CMakeLists.txt' % (pattern, source_path))
+    if not result.succeeded:
+        return []
+    options = []
+    for line in result.splitlines():
+        name = line.split('(')[-1].strip()
+        if name and name not in options:
+            options.append(name)
+    return options
+
+
+def cmake_options(source_path, generator='make', pch=False, unity=False):
+    """Get the cmake arguments for a generator and speed up options.
+
+    Precompiled headers are enabled through whatever option the project's
+    own CMakeLists.txt offers for them (e.g. ``ENABLE_PCH``) and are skipped
+    with a warning if there is none. Unity builds use
+    ``CMAKE_UNITY_BUILD`` which needs cmake 3.16 or newer.
+
+    :param source_path: Path to the top level source dir on the remote host.
+    :type source_path: str
+
+    :param generator: Either 'make' or 'ninja'. Default 'make'.
+    :type generator: str
+
+    :param pch: Whether precompiled headers should be enabled.
+    :type pch: bool
+
+    :param unity: Whether a unity (jumbo) build should be enabled.
+    :type unity: bool
+
+    :returns: Arguments to add to the cmake command line.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    if generator not in GENERATORS:
+        raise Exception('Unknown cmake generator: %s' % generator)
+    options = '-G "%s" ' % GENERATORS[generator]
+    if pch:
+        pch_options = _find_cmake_options(
+            source_path, ['PCH', 'PRECOMPILED'])
+        if not pch_options:
+            fastprint(red(
+                'No precompiled header option in %s, skipping.\n' %
+                source_path))
+        for option in pch_options:
+            options += '-D%s=ON ' % option
+    if unity:
+        if get_cmake_version() >= (3, 16):
+            options += '-DCMAKE_UNITY_BUILD=ON '
+        else:
+            fastprint(red('Unity builds need cmake 3.16, skipping.\n'))
+    return options
+
+
+def cmake_build_command(
+        generator='make', jobs=1, target='install', load=None):
+    """Get the command that runs the build for a cmake generator.
+
+    :param generator: Either 'make' or 'ninja'. Default 'make'.
+    :type generator: str
+
+    :param jobs: Number of parallel jobs.
+    :type jobs: int, str
+
+    :param target: Target to build. Default 'install'.
+    :type target: str
+
+    :param load: Optional load average above which no new jobs are started.
+    :type load: int, str
+
+    :returns: Build command e.g. ``ninja -j 4 -l 4 install``.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    if generator not in GENERATORS:
+        raise Exception('Unknown cmake generator: %s' % generator)
+    tool = 'ninja' if generator == 'ninja' else 'make'
+    command = '%s -j %s ' % (tool, jobs)
+    if load is not None:
+        command += '-l %s ' % load
+    return command + target
@@ -0,0 +1,153 @@
+# coding=utf-8
+"""
+Debian packaging of source builds.
+==================================
+
+Tools for turning a fabgis source build (proj4, hdf5, GDAL) into a
+versioned .deb once and installing it on the rest of the fleet through apt.
+
+A build made with ``package=True`` is installed into a staging dir instead
+of /usr/local, wrapped up as ``fabgis-<name>`` and installed with dpkg, so
+it can be cleanly upgraded or removed. The .deb is also copied to
+``fabgis_resources/debs`` on the control host. Publish that dir to a web
+server with :func:`publish_deb_repository` and install from it on other
+hosts with :func:`install_deb_package`.
+
+"""
+import glob
+import os
+from StringIO import StringIO
+from fabric.api import task, run, sudo, get, put, fastprint, cd, hide, env
+from fabric.colors import green
+from fabric.contrib.files import exists
+import fabtools
+from .common import setup_env
+from .utilities import append_if_not_present
+
+LOCAL_DEB_REPOSITORY = os.path.join('fabgis_resources', 'debs')
+DEB_SOURCES_FILE = '/etc/apt/sources.list.d/fabgis.list'
+
+
+def build_deb(name, version, code_path, description, install_command=None):
+    """Install a configured and compiled source tree as a .deb.
+
+    The tree is installed into a staging dir with DESTDIR, packaged as
+    ``fabgis-<name>`` with an ld.so.conf.d entry for /usr/local/lib,
+    installed on the host with dpkg and copied to the control host.
+
+    :param name: Short name of the project e.g. 'proj4'.
+    :type name: str
+
+    :param version: Upstream version e.g. '4.8.0'. The package version is
+        ``<version>-1fabgis``.
+    :type version: str
+
+    :param code_path: Path to the built source tree on the remote host.
+    :type code_path: str
+
+    :param description: One line package description.
+    :type description: str
+
+    :param install_command: Command that installs into ``$DESTDIR``.
+        Defaults to ``make install``.
+    :type install_command: str
+
+    :returns: Path to the .deb on the remote host.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    if install_command is None:
+        install_command = 'make install'
+    package = 'fabgis-%s' % name
+    with hide('output'):
+        architecture = run('dpkg --print-architecture').strip()
+    deb_version = '%s-1fabgis' % version
+    stage = '/tmp/%s-stage' % package
+    deb_file = '/tmp/%s_%s_%s.deb' % (package, deb_version, architecture)
+
+    run('rm -rf %s' % stage)
+    run('mkdir -p %s/DEBIAN %s/etc/ld.so.conf.d' % (stage, stage))
+    with cd(code_path):
+        run('DESTDIR=%s %s' % (stage, install_command))
+    put(StringIO('/usr/local/lib\n'),
+        '%s/etc/ld.so.conf.d/%s.conf' % (stage, package))
+    control = (
+        'Package: %(package)s\n'
+        'Version: %(version)s\n'
+        'Architecture: %(architecture)s\n'
+        'Maintainer: fabgis <%(user)s@%(hostname)s>\n'
+        'Section: science\n'
+        'Priority: optional\n'
+        'Description: %(description)s\n'
+        ' Built from source by fabgis.\n' % {
+            'package': package,
+            'version': deb_version,
+            'architecture': architecture,
+            'user': env.fg.user,
+            'hostname': env.fg.hostname,
+            'description': description})
+    put(StringIO(control), '%s/DEBIAN/control' % stage)
+    for script in ('postinst', 'postrm'):
+        put(StringIO('#!/bin/sh\nset -e\nldconfig\n'),
+            '%s/DEBIAN/%s' % (stage, script),
+            mode=0o755)
+
+    fabtools.require.deb.package('fakeroot')
+    run('fakeroot dpkg-deb --build %s %s' % (stage, deb_file))
+    sudo('dpkg -i %s' % deb_file)
+    run('rm -rf %s' % stage)
+
+    if not os.path.exists(LOCAL_DEB_REPOSITORY):
+        os.makedirs(LOCAL_DEB_REPOSITORY)
+    get(deb_file, os.path.join(
+        LOCAL_DEB_REPOSITORY, os.path.basename(deb_file)))
+    fastprint(green('Built and installed %s %s\n' % (package, deb_version)))
+    return deb_file
+
+
+@task
+def publish_deb_repository(repository_path='/var/www/fabgis-debs'):
+    """Publish the .debs collected on the control host as an apt repository.
+
+    The debs in fabgis_resources/debs are uploaded to repository_path on
+    the remote host, indexed and served by apache.
+
+    :param repository_path: Directory under the apache document root to
+        publish to. Default /var/www/fabgis-debs.
+    :type repository_path: str
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    fabtools.require.deb.packages(['apache2', 'dpkg-dev'])
+    fabtools.require.directory(repository_path, use_sudo=True)
+    for deb in glob.glob(os.path.join(LOCAL_DEB_REPOSITORY, '*.deb')):
+        remote_deb = os.path.join(repository_path, os.path.basename(deb))
+        if not exists(remote_deb):
+            put(deb, remote_deb, use_sudo=True)
+    with cd(repository_path):
+        sudo('dpkg-scanpackages . /dev/null | gzip -9c > Packages.gz')
+    sudo('chmod o+rX -R %s' % repository_path)
+    fastprint(green('Published fabgis packages in %s\n' % repository_path))
+
+
+@task
+def install_deb_package(name, repository_url):
+    """Install or upgrade a fabgis built package from a fabgis repository.
+
+    :param name: Short name of the project e.g. 'proj4', 'hdf5' or 'gdal'.
+    :type name: str
+
+    :param repository_url: Url of the repository published with
+        :func:`publish_deb_repository` e.g. http://repo.example.com/fabgis-debs
+    :type repository_url: str
+
+    .. versionadded:: 0.18.0
+    """
+    # The repository is unsigned so it is explicitly trusted
+    source = 'deb [trusted=yes] %s ./' % repository_url
+    append_if_not_present(DEB_SOURCES_FILE, source, use_sudo=True)
+    fabtools.deb.update_index(quiet=True)
+    sudo('apt-get install -y fabgis-%s' % name)
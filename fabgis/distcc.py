@@ -0,0 +1,194 @@
+# coding=utf-8
+"""
+Distcc build farm tasks.
+========================
+
+Tools for spreading QGIS and GDAL compiles over idle fleet hosts with
+distcc. Workers are enrolled from the build host with
+:func:`setup_distcc_farm`, which only keeps workers whose gcc matches the
+build host's. Before each distributed build the workers are health checked
+and unreachable ones are left out of ``/etc/distcc/hosts``.
+
+Distcc is chained behind ccache (``CCACHE_PREFIX=distcc``) so cache hits
+never leave the build host.
+
+"""
+from contextlib import contextmanager
+from StringIO import StringIO
+from fabric.api import (
+    task, run, sudo, fastprint, put, hide, settings, shell_env)
+from fabric.colors import green, red
+import fabtools
+from .common import setup_env
+from .system import get_build_jobs
+
+DISTCC_PORT = 3632
+# All enrolled workers - /etc/distcc/hosts only lists the healthy ones
+DISTCC_FARM_FILE = '/etc/distcc/hosts.fabgis'
+DISTCC_HOSTS_FILE = '/etc/distcc/hosts'
+
+
+def get_gcc_version():
+    """Get the full gcc version of the remote host e.g. '4.8.2'.
+
+    :rtype: str
+    """
+    with hide('output'):
+        return run('gcc -dumpfullversion -dumpversion').strip()
+
+
+@task
+def setup_distcc_worker(allowed_network='10.0.0.0/8', jobs=None):
+    """Set up the remote host as a distcc worker.
+
+    :param allowed_network: Network (CIDR) of the build hosts allowed to
+        send compile jobs.
+    :type allowed_network: str
+
+    :param jobs: Number of compile jobs the worker accepts. Defaults to the
+        job count :func:`fabgis.system.get_build_jobs` gives for QGIS.
+    :type jobs: int
+
+    :returns: A tuple of the worker's gcc version and job count.
+    :rtype: tuple
+
+    .. versionadded:: 0.18.0
+    """
+    fabtools.require.deb.packages(['build-essential', 'distcc'])
+    if jobs is None:
+        jobs, _ = get_build_jobs('qgis')
+    defaults = (
+        'STARTDISTCC="true"\n'
+        'ALLOWEDNETS="%(network)s"\n'
+        'LISTENER="0.0.0.0"\n'
+        'NICE="10"\n'
+        'JOBS="%(jobs)s"\n'
+        'ZEROCONF="false"\n' % {
+            'network': allowed_network,
+            'jobs': jobs})
+    put(StringIO(defaults), '/etc/default/distcc', use_sudo=True, mode=0o644)
+    # Newer distcc only runs compilers it has masquerade links for
+    with settings(warn_only=True):
+        sudo('update-distcc-symlinks')
+    fabtools.require.service.restarted('distcc')
+    return get_gcc_version(), jobs
+
+
+@task
+def setup_distcc_farm(workers, allowed_network='10.0.0.0/8'):
+    """Enroll a set of hosts as distcc workers for the current build host.
+
+    Workers whose gcc version differs from the build host's are skipped
+    since mixing toolchains gives broken or subtly different objects.
+
+    :param workers: Semicolon separated list of worker host strings e.g.
+        ``tim@node1;node2:2222``.
+    :type workers: str
+
+    :param allowed_network: Network (CIDR) the build host is in.
+    :type allowed_network: str
+
+    To run e.g.::
+
+        fab -H buildhost setup_distcc_farm:"node1;node2;node3"
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    fabtools.require.deb.package('distcc')
+    gcc_version = get_gcc_version()
+    farm = []
+    for worker in workers.split(';'):
+        with settings(host_string=worker):
+            worker_version, jobs = setup_distcc_worker(
+                allowed_network=allowed_network)
+        if worker_version != gcc_version:
+            fastprint(red('Skipping %s: gcc %s does not match %s\n' % (
+                worker, worker_version, gcc_version)))
+            continue
+        host = worker.split('@')[-1].split(':')[0]
+        farm.append('%s/%s' % (host, jobs))
+        fastprint(green('Enrolled %s with %s jobs\n' % (host, jobs)))
+    put(StringIO('\n'.join(farm) + '\n'),
+        DISTCC_FARM_FILE,
+        use_sudo=True,
+        mode=0o644)
+    check_distcc_workers()
+
+
+@task
+def check_distcc_workers():
+    """Health check the enrolled distcc workers of this build host.
+
+    Each worker's distcc port is probed in a single remote call and only
+    the reachable workers are written to /etc/distcc/hosts.
+
+    :returns: Total number of jobs the reachable workers accept.
+    :rtype: int
+
+    .. versionadded:: 0.18.0
+    """
+    with settings(warn_only=True), hide('output', 'warnings'):
+        result = run(
+            'test -f %(farm)s && while read worker; do '
+            'host=${worker%%%%/*}; '
+            'if timeout 3 bash -c "</dev/tcp/$host/%(port)s" 2> /dev/null; '
+            'then echo "$worker ok"; else echo "$worker down"; fi; '
+            'done < %(farm)s' % {
+                'farm': DISTCC_FARM_FILE,
+                'port': DISTCC_PORT})
+    healthy = []
+    capacity = 0
+    for line in result.splitlines():
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        worker, state = parts
+        if state == 'ok':
+            healthy.append(worker)
+            capacity += int(worker.split('/')[-1])
+        else:
+            fastprint(red('distcc worker %s is unreachable\n' % worker))
+    if result.succeeded:
+        put(StringIO('\n'.join(healthy) + '\n'),
+            DISTCC_HOSTS_FILE,
+            use_sudo=True,
+            mode=0o644)
+    fastprint(green('%s distcc workers with %s jobs available\n' % (
+        len(healthy), capacity)))
+    return capacity
+
+
+@contextmanager
+def distcc_jobs(project, distributed=True):
+    """Context manager giving the job count for a possibly distributed build.
+
+    When distributed and healthy workers are available, compiles inside the
+    block go through distcc and the job count grows by the farm's capacity.
+    Otherwise it falls back to a local build.
+
+    :param project: Name of the project being built - see
+        :func:`fabgis.system.get_build_jobs`.
+    :type project: str
+
+    :param distributed: Whether the farm should be used at all.
+    :type distributed: bool
+
+    e.g.::
+
+        with distcc_jobs('gdal') as (jobs, load):
+            run('make -j %s -l %s' % (jobs, load))
+
+    .. versionadded:: 0.18.0
+    """
+    jobs, load = get_build_jobs(project)
+    capacity = 0
+    if distributed:
+        capacity = check_distcc_workers()
+    if not capacity:
+        yield jobs, load
+        return
+    fastprint(green('Distributing %s build over %s jobs\n' % (
+        project, jobs + capacity)))
+    with shell_env(CCACHE_PREFIX='distcc'):
+        yield jobs + capacity, load
@@ -0,0 +1,170 @@
+# coding=utf-8
+"""
+Source tarball download cache.
+==============================
+
+Source tarballs are downloaded once to ``fabgis_resources/downloads`` on the
+control host and pushed from there to the remote hosts over the fabric ssh
+connection, so provisioning does not depend on upstream download sites
+being fast or up.
+
+Each cached tarball has a ``.sha256`` file next to it. When a checksum is
+given or pinned in TARBALL_SHA256 it must match, otherwise the checksum of
+the first download is recorded and later copies are verified against it.
+Downloads shorter than the Content-Length the server announced are
+rejected. A tarball is only pushed when the remote copy is missing or its
+checksum differs.
+
+"""
+import hashlib
+import os
+import urllib2
+from multiprocessing.pool import ThreadPool
+from fabric.api import task, run, put, fastprint, settings, hide
+from fabric.colors import green, blue
+
+LOCAL_DOWNLOAD_CACHE = os.path.join('fabgis_resources', 'downloads')
+
+# Tarballs fabgis builds from by default - see prefetch_tarballs
+DEFAULT_TARBALLS = [
+    'http://download.osgeo.org/proj/proj-4.8.0.tar.gz',
+    'http://www.hdfgroup.org/ftp/HDF5/current/src/hdf5-1.8.11.tar.gz',
+    'http://download.osgeo.org/postgis/source/postgis-1.5.8.tar.gz',
+    'http://download.osgeo.org/postgis/source/postgis-2.1.1.tar.gz',
+    'http://effbot.org/downloads/Imaging-1.1.7.tar.gz',
+]
+
+# Known good sha256 of tarballs by url, checked on every download. Only
+# add checksums verified against upstream - prefetch_tarballs lists the
+# tarballs that are not pinned yet.
+TARBALL_SHA256 = {}
+
+
+def _file_sha256(path):
+    """Get the hex sha256 digest of a local file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as local_file:
+        for block in iter(lambda: local_file.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fetch_tarball(url, sha256=None):
+    """Get a tarball into the control host download cache.
+
+    :param url: Url of the tarball.
+    :type url: str
+
+    :param sha256: Optional expected hex sha256 of the tarball. Defaults to
+        the checksum pinned in TARBALL_SHA256, if any.
+    :type sha256: str
+
+    :returns: A tuple of the local path of the tarball and its sha256.
+    :rtype: tuple
+
+    :raises: Exception if the tarball does not match its checksum or the
+        download was cut short.
+
+    .. versionadded:: 0.18.0
+    """
+    if not os.path.exists(LOCAL_DOWNLOAD_CACHE):
+        os.makedirs(LOCAL_DOWNLOAD_CACHE)
+    path = os.path.join(LOCAL_DOWNLOAD_CACHE, url.split('/')[-1])
+    checksum_path = '%s.sha256' % path
+    if sha256 is None:
+        sha256 = TARBALL_SHA256.get(url)
+    if sha256 is None and os.path.exists(checksum_path):
+        with open(checksum_path) as checksum_file:
+            sha256 = checksum_file.read().strip()
+
+    if os.path.exists(path):
+        checksum = _file_sha256(path)
+        if sha256 is None or checksum == sha256:
+            return path, checksum
+        fastprint(blue('Cached %s is corrupt, downloading again.\n' % path))
+
+    fastprint(blue('Downloading %s\n' % url))
+    partial_path = '%s.part' % path
+    digest = hashlib.sha256()
+    size = 0
+    response = urllib2.urlopen(url)
+    expected_size = response.info().getheader('Content-Length')
+    with open(partial_path, 'wb') as local_file:
+        for block in iter(lambda: response.read(1024 * 1024), ''):
+            digest.update(block)
+            local_file.write(block)
+            size += len(block)
+    if expected_size is not None and size != int(expected_size):
+        os.remove(partial_path)
+        raise Exception('Download of %s cut short: got %s of %s bytes' % (
+            url, size, expected_size))
+    checksum = digest.hexdigest()
+    if sha256 is not None and checksum != sha256:
+        os.remove(partial_path)
+        raise Exception('Checksum mismatch for %s: expected %s, got %s' % (
+            url, sha256, checksum))
+    os.rename(partial_path, path)
+    with open(checksum_path, 'w') as checksum_file:
+        checksum_file.write('%s\n' % checksum)
+    return path, checksum
+
+
+@task
+def prefetch_tarballs(urls=None, workers=4):
+    """Download tarballs into the control host cache in parallel.
+
+    Nothing is done on the remote host so this can be run without -H.
+
+    :param urls: Semicolon separated list of tarball urls. Defaults to the
+        tarballs fabgis builds from.
+    :type urls: str
+
+    :param workers: Number of concurrent downloads. Default 4.
+    :type workers: int
+
+    .. versionadded:: 0.18.0
+    """
+    if urls is None:
+        urls = DEFAULT_TARBALLS
+    else:
+        urls = urls.split(';')
+    pool = ThreadPool(int(workers))
+    try:
+        results = pool.map(fetch_tarball, urls)
+    finally:
+        pool.close()
+    for url, (path, checksum) in zip(urls, results):
+        fastprint(green('%s %s\n' % (checksum, path)))
+        if url not in TARBALL_SHA256:
+            fastprint(blue('%s has no pinned checksum in TARBALL_SHA256\n' % (
+                url)))
+
+
+def put_tarball(url, remote_dir, sha256=None):
+    """Push a cached tarball to the remote host if it is not there already.
+
+    :param url: Url of the tarball.
+    :type url: str
+
+    :param remote_dir: Directory on the remote host to put the tarball in.
+    :type remote_dir: str
+
+    :param sha256: Optional expected hex sha256 of the tarball.
+    :type sha256: str
+
+    :returns: Path to the tarball on the remote host.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    local_path, checksum = fetch_tarball(url, sha256)
+    remote_path = '%s/%s' % (remote_dir, os.path.basename(local_path))
+    with settings(warn_only=True), hide('output', 'warnings'):
+        remote_checksum = run(
+            'sha256sum %s 2> /dev/null | cut -d " " -f 1' % remote_path)
+    if remote_checksum.strip() == checksum:
+        fastprint(blue('%s is up to date.\n' % remote_path))
+    else:
+        run('mkdir -p %s' % remote_dir)
+        put(local_path, remote_path)
+    return remote_path
@@ -4,18 +4,179 @@ GDAL Related Tasks.
 ===================
 
 Module for gdal related tasks"""
+import time
+from StringIO import StringIO
 import fabtools
 from fabric.contrib.files import exists, append
-from fabric.api import fastprint, run, cd, env, task, sudo, settings
+from fabric.api import (
+    fastprint, run, cd, env, task, sudo, settings, hide, put)
+from fabric.colors import green, blue
 
 from .common import add_ubuntugis_ppa, setup_env
-from .system import setup_ccache, get_processor_count
+from .system import (
+    require_ccache, get_make_flags, ccache_statistics, tmpfs_build_dir,
+    get_host_resources, resolve_march)
 from .proj4 import build_proj4
+from .distcc import distcc_jobs
+from .debian import build_deb
+from .artifacts import artifact_key
+from .git import update_shallow_checkout
+from .history import build_history, build_phase, set_build_fact
+
+# Build state kept in the GDAL checkout for incremental builds
+GDAL_CONFIGURE_STAMP = '.fabgis-configure'
+GDAL_BUILD_STAMP = '.fabgis-build'
+GDAL_MANIFEST_STAMP = '.fabgis-install-manifest'
+
+GDAL_RUNTIME_PROFILE = '/etc/profile.d/fabgis-gdal.sh'
+
+# Raster drivers (GDAL_FORMATS names) for build_gdal(drivers='server'):
+# what map servers typically read. Vector support (shapefile, PostGIS etc.)
+# is always built.
+GDAL_SERVER_DRIVERS = [
+    'gtiff', 'vrt', 'hfa', 'aaigrid', 'aigrid', 'nitf', 'jpeg', 'png', 'gif',
+    'wms', 'xyz', 'postgisraster']
+
+# Drivers every build needs, whatever the whitelist
+GDAL_REQUIRED_DRIVERS = ['gtiff', 'vrt', 'mem', 'raw']
+
+# Configure flags for whitelisted builds: no python bindings and none of
+# the optional libraries only the left out drivers use.
+GDAL_MINIMAL_FLAGS = (
+    '--with-libtiff=internal '
+    '--with-geotiff=internal '
+    '--with-pg '
+    '--without-python '
+    '--without-jp2mrs '
+    '--without-spatialite '
+    '--without-sqlite3 '
+    '--without-hdf4 '
+    '--without-hdf5 '
+    '--without-netcdf '
+    '--without-ogdi '
+    '--without-jasper '
+    '--without-openjpeg '
+    '--without-xerces '
+    '--without-mysql '
+    '--without-odbc '
+    '--without-pcraster '
+    '--without-libtool')
+
+# Named compiler settings for build_gdal. GDAL's own default is -g -O2.
+# Builds using -march=native can not be packaged for other hosts.
+GDAL_BUILD_PROFILES = {
+    'default': {
+        'cflags': '',
+        'ldflags': '',
+        'tools': ''},
+    'release': {
+        'cflags': '-O2 -march=%(march)s',
+        'ldflags': '',
+        'tools': ''},
+    'fast': {
+        'cflags': '-O3 -march=%(march)s',
+        'ldflags': '',
+        'tools': ''},
+    # The static libgdal.a needs the lto aware archiver
+    'lto': {
+        'cflags': '-O3 -march=%(march)s -flto',
+        'ldflags': '-flto',
+        'tools': 'AR=gcc-ar RANLIB=gcc-ranlib'},
+}
+
+
+def _read_stamp(path):
+    """Read a build stamp file on the remote host, '' if there is none."""
+    with settings(warn_only=True), hide('output', 'warnings'):
+        result = run('cat %s 2> /dev/null' % path)
+    return result.strip() if result.succeeded else ''
+
+
+def _write_stamp(path, value):
+    """Write a build stamp file on the remote host."""
+    with hide('output'):
+        run('echo "%s" > %s' % (value, path))
+
+
+def get_gdal_source(source='svn', ref=None, mirror=False):
+    """Check out or update the GDAL sources.
+
+    :param source: 'svn' to check out or update svn trunk from
+        env.fg.gdal_svn_url, or 'git' for a depth 1 clone of ref from
+        env.fg.gdal_git_url. Default 'svn'.
+    :type source: str
+
+    :param ref: Tag or full commit hash to check out from git e.g.
+        'v2.4.4'. Needed for git.
+    :type ref: str
+
+    :param mirror: Whether a new git checkout should be seeded from the
+        control host mirror rather than fetched by the remote host - see
+        :func:`fabgis.git.update_shallow_checkout`. Default False.
+    :type mirror: bool
+
+    :returns: A tuple of the path of the GDAL source tree (the dir with
+        configure in it) and the source revision.
+    :rtype: tuple
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    code_base = '%s/cpp' % env.fg.workspace
+    if source == 'git':
+        if ref is None:
+            raise Exception('A tag or commit is needed to build GDAL from git')
+        repo_path = '%s/gdal-git' % code_base
+        commit = update_shallow_checkout(
+            repo_path,
+            env.fg.gdal_git_url,
+            ref,
+            mirror_name='gdal' if mirror else None)
+        code_path = repo_path
+        # Before GDAL 3.5 the sources were in a gdal dir in the repository
+        if exists('%s/gdal/configure' % repo_path):
+            code_path = '%s/gdal' % repo_path
+        return code_path, commit[:10]
+
+    if source != 'svn':
+        raise Exception('Unknown GDAL source: %s' % source)
+    fabtools.require.deb.package('subversion')
+    code_path = '%s/gdal' % code_base
+    if not exists(code_path):
+        fastprint('Repo checkout does not exist, creating.')
+        run('mkdir -p %s' % code_base)
+        with cd(code_base):
+            run('svn co %s gdal' % env.fg.gdal_svn_url)
+    else:
+        fastprint('Repo checkout does exist, updating.')
+        with cd(code_path):
+            # Get any updates first
+            run('svn update')
+    with cd(code_path):
+        revision = run('svnversion .').split(':')[-1]
+    return code_path, revision.strip().rstrip('MSP')
 
 
 @task
-def build_gdal(with_ecw=False, with_mrsid=False):
-    """Clone or update GDAL from svn then build it.
+def build_gdal(
+        with_ecw=False,
+        with_mrsid=False,
+        distributed=False,
+        ram_build=False,
+        package=False,
+        force=False,
+        source='svn',
+        ref=None,
+        mirror=False,
+        profile='default',
+        march='native',
+        drivers=None):
+    """Get GDAL from svn or git then build it.
+
+    Builds are incremental: configure is only rerun when the configure
+    flags or the configure script change and nothing is built at all when
+    neither the flags nor the source revision changed since the last build
+    and libgdal is still installed.
 
     :param with_ecw: Whether to build with ecw support.
     :type with_ecw: bool
@@ -23,12 +184,67 @@ def build_gdal(with_ecw=False, with_mrsid=False):
     :param with_mrsid: Whether to build with mrsid support.
     :type with_mrsid: bool
 
+    :param distributed: Whether to spread the compile over the distcc farm
+        set up with :func:`fabgis.distcc.setup_distcc_farm`. Default False.
+    :type distributed: bool
+
+    :param ram_build: Whether to copy the sources to a tmpfs and build there
+        when the host has enough free memory - see
+        :func:`fabgis.system.tmpfs_build_dir`. Default False.
+    :type ram_build: bool
+
+    :param package: Whether to install proj4 and GDAL as fabgis-proj4 and
+        fabgis-gdal .debs and keep the .debs for other hosts - see
+        :func:`fabgis.debian.build_deb`. The GDAL package version is the
+        GDAL version plus the source revision. Default False.
+    :type package: bool
+
+    :param force: Whether to do a clean build even if GDAL is up to date.
+        Default False.
+    :type force: bool
+
+    :param source: 'svn' for a checkout of svn trunk or 'git' for a shallow
+        clone of a pinned ref - see :func:`get_gdal_source`. Default 'svn'.
+    :type source: str
+
+    :param ref: Tag or commit hash to build from git.
+    :type ref: str
+
+    :param mirror: Whether a new git checkout is seeded from the control
+        host mirror. Default False.
+    :type mirror: bool
+
+    :param profile: Name of the compiler settings to use from
+        GDAL_BUILD_PROFILES: 'default', 'release' (-O2), 'fast' (-O3) or
+        'lto' (-O3 with link time optimisation). Default 'default'.
+    :type profile: str
+
+    :param march: Target architecture for the optimised profiles. Use e.g.
+        'x86-64' for binaries that must run on other hosts, which packaged
+        builds with an optimised profile must. For a distributed build
+        'native' is resolved to the build host's CPU first. Default
+        'native'.
+    :type march: str
+
+    :param drivers: Semicolon separated whitelist of the raster drivers to
+        build, by their GDAL_FORMATS name e.g. 'gtiff;vrt;hfa', or 'server'
+        for GDAL_SERVER_DRIVERS. The python bindings and optional libraries
+        are left out too, giving a faster build and a smaller libgdal.
+        Default None - build every driver.
+    :type drivers: str
+
     """
+    if profile not in GDAL_BUILD_PROFILES:
+        raise Exception('Unknown GDAL build profile: %s' % profile)
+    if (package and march == 'native' and
+            '%(march)s' in GDAL_BUILD_PROFILES[profile]['cflags']):
+        raise Exception(
+            'A -march=native GDAL can not be packaged for other hosts, '
+            'pass e.g. march=x86-64')
     setup_env()
     add_ubuntugis_ppa()
-    fabtools.require.deb.package('subversion')
     fabtools.require.deb.package('build-essential')
-    setup_ccache()
+    require_ccache()
     fabtools.require.deb.package('libhdf5-serial-dev')
     fabtools.require.deb.package('libhdf5-7')
     fabtools.require.deb.package('libhdf4g-dev')
@@ -36,22 +252,10 @@ def build_gdal(with_ecw=False, with_mrsid=False):
     fabtools.require.deb.package('libtiff4-dev')
     fabtools.require.deb.package('python-dev')
 
-    # Note that gdal does not compile against proj4, only uses the .so at
-    # runtime
-    build_proj4()
-
     code_base = '%s/cpp' % env.fg.workspace
-    code_path = '%s/gdal' % code_base
-    if not exists(code_path):
-        fastprint('Repo checkout does not exist, creating.')
-        run('mkdir -p %s' % code_base)
-        with cd(code_base):
-            run('svn co %s gdal' % env.fg.gdal_svn_url)
-    else:
-        fastprint('Repo checkout does exist, updating.')
-        with cd(code_path):
-            # Get any updates first
-            run('svn update')
+    fetch_start = time.time()
+    code_path, revision = get_gdal_source(source, ref, mirror)
+    fetch_time = time.time() - fetch_start
 
     flags = (
         '--with-libtiff=internal '
@@ -60,8 +264,23 @@ def build_gdal(with_ecw=False, with_mrsid=False):
         '--without-jp2mrs '
         '--with-spatialite '
         '--without-libtool')
-
-    processor_count = get_processor_count()
+    # Extra make arguments, the same for the build and install
+    make_args = ''
+    if drivers is not None:
+        if drivers == 'server':
+            formats = list(GDAL_SERVER_DRIVERS)
+        else:
+            formats = drivers.split(';')
+        formats += [
+            driver for driver in GDAL_REQUIRED_DRIVERS
+            if driver not in formats]
+        if with_ecw:
+            formats.append('ecw')
+        if with_mrsid:
+            formats.append('mrsid')
+        flags = GDAL_MINIMAL_FLAGS
+        # GDAL_FORMATS also decides which drivers GDALAllRegister registers
+        make_args = ' GDAL_FORMATS="%s"' % ' '.join(formats)
 
     # Currently you need to have downloaded the MRSID sdk to remote home dir
     if with_mrsid:
@@ -82,20 +301,169 @@ def build_gdal(with_ecw=False, with_mrsid=False):
         if not exists('/usr/local/include/ECW.h'):
             with cd(ecw_dir):
                 run('./configure')
-                run('make -j %s' % processor_count)
+                run('make %s' % get_make_flags('ecw'))
                 sudo('make install')
         flags += ' --with-ecw=/usr/local'
 
-    with cd(code_path):
-        # Dont fail if make clean does not work
+    if distributed and '%(march)s' in GDAL_BUILD_PROFILES[profile]['cflags']:
+        # Each distcc worker would take -march=native as its own CPU
+        march = resolve_march(march)
+    build_settings = dict(
+        (key, value % {'march': march})
+        for key, value in GDAL_BUILD_PROFILES[profile].items())
+    # Leaving CFLAGS unset keeps GDAL's default for C code
+    configure = build_settings['tools']
+    if build_settings['cflags']:
+        configure += ' CFLAGS="%(cflags)s"' % build_settings
+    configure += ' CXXFLAGS="%s"' % (
+        '-fPIC %s' % build_settings['cflags']).strip()
+    if build_settings['ldflags']:
+        configure += ' LDFLAGS="%(ldflags)s"' % build_settings
+    configure = '%s ./configure %s' % (configure.strip(), flags)
+    # A source update can change configure itself without changing flags
+    with cd(code_path), hide('output'):
+        configure_sources = run('sha256sum configure GDALmake.opt.in')
+    fingerprint = artifact_key(
+        configure, make_args, package, configure_sources)
+    configure_stamp = '%s/%s' % (code_path, GDAL_CONFIGURE_STAMP)
+    build_stamp = '%s/%s' % (code_path, GDAL_BUILD_STAMP)
+    build_key = artifact_key(fingerprint, revision)
+    configured = not force and _read_stamp(configure_stamp) == fingerprint
+    # The stamps live in the source tree, so check GDAL is still installed
+    if (not force and _read_stamp(build_stamp) == build_key and
+            exists('/usr/local/lib/libgdal.so')):
+        fastprint(green('GDAL r%s is up to date, not building.\n' % revision))
+        return
+
+    # Note that gdal does not compile against proj4, only uses the .so at
+    # runtime
+    build_proj4(ram_build=ram_build, package=package)
+
+    with build_history(
+            'gdal', revision=revision, profile=profile,
+            source=source) as record:
+        record['phases']['fetch'] = round(fetch_time, 1)
+        with tmpfs_build_dir(
+                '%s-tmpfs' % code_path,
+                'gdal',
+                copy_from=code_path,
+                enabled=ram_build) as build_path:
+            with cd(build_path), ccache_statistics('GDAL'):
+                # A tmpfs build starts from the unconfigured tree on disk
+                on_disk = build_path == code_path
+                if not configured or not on_disk:
+                    _write_stamp(configure_stamp, '')
+                    # Dont fail if make clean does not work
+                    with settings(warn_only=True):
+                        run('make clean')
+                    with build_phase('configure'):
+                        run(configure)
+                else:
+                    fastprint(blue('GDAL configure flags unchanged, building '
+                                   'incrementally.\n'))
+                with build_phase('compile'), \
+                        distcc_jobs('gdal', distributed) as (jobs, load):
+                    set_build_fact('jobs', jobs)
+                    run('make -j %s -l %s%s' % (jobs, load, make_args))
+                with build_phase('install'):
+                    if package:
+                        with cd(code_path):
+                            version = '%s+%s%s' % (
+                                run('cat VERSION').strip(), source, revision)
+                        build_deb(
+                            'gdal', version, build_path,
+                            'GDAL geospatial data abstraction library',
+                            install_command='make install%s' % make_args)
+                    else:
+                        sudo('make install%s' % make_args)
+        if on_disk:
+            _write_stamp(configure_stamp, fingerprint)
+        _write_stamp(build_stamp, build_key)
+        if package:
+            # The package ships its own ld.so.conf.d entry
+            return
+
+        # Only refresh the linker cache if the installed libraries changed
+        with hide('output'):
+            manifest = run(
+                'find /usr/local/lib -maxdepth 1 -name "libgdal*" | sort | '
+                'xargs -r sha256sum | sha256sum')
+        manifest_stamp = '%s/%s' % (code_path, GDAL_MANIFEST_STAMP)
+        if _read_stamp(manifest_stamp) == manifest.strip():
+            fastprint(blue('Installed GDAL libraries unchanged, skipping '
+                           'ldconfig.\n'))
+            return
+        _write_stamp(manifest_stamp, manifest.strip())
+        # Write to ld path too so libs are loaded nicely
+        ld_file = '/etc/ld.so.conf.d/usr_local_lib.conf'
         with settings(warn_only=True):
-            run('make clean')
-        run('CXXFLAGS=-fPIC ./configure %s' % flags)
-        run('make -j %s' % processor_count)
-        sudo('make install')
-    # Write to ld path too so libs are loaded nicely
-    ld_file = '/etc/ld.so.conf.d/usr_local_lib.conf'
-    with settings(warn_only=True):
-        sudo('rm %s' % ld_file)
-    append(ld_file, '/usr/local/lib', use_sudo=True)
-    sudo('ldconfig')
+            sudo('rm %s' % ld_file)
+        append(ld_file, '/usr/local/lib', use_sudo=True)
+        sudo('ldconfig')
+
+
+@task
+def setup_gdal_runtime(processes=None, cache_fraction=0.25):
+    """Configure GDAL caching and threads for map server processes.
+
+    GDAL_CACHEMAX (the raster block cache), GDAL_NUM_THREADS and the VSI
+    file cache are set system wide: in /etc/profile.d for shells and in an
+    apache conf for QGIS server (FastCGI) and Mapserver (CGI). The block
+    cache is per process so cache_fraction of the host RAM is shared out
+    between the server processes, and the cores are shared out as threads.
+
+    :param processes: Number of map server processes to size for. FastCGI
+        is limited to this many processes. Defaults to the number of cores.
+    :type processes: int
+
+    :param cache_fraction: Fraction of host RAM to give to GDAL block
+        caches. Default 0.25.
+    :type cache_fraction: float
+
+    :returns: The settings written.
+    :rtype: dict
+
+    To run e.g.::
+
+        fab -H 192.168.1.1:2222 setup_gdal_runtime:processes=8
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    resources = get_host_resources()
+    cores = resources['cores']
+    if processes is None:
+        processes = cores
+    processes = max(1, int(processes))
+    cache_max = max(
+        64, int(resources['total_memory'] * float(cache_fraction) / processes))
+    # The VSI cache is per open file so it is kept well below the block cache
+    vsi_cache_size = max(25, cache_max / 8) * 1024 * 1024
+    runtime_settings = {
+        'GDAL_CACHEMAX': cache_max,
+        'GDAL_NUM_THREADS': max(1, cores / processes),
+        'VSI_CACHE': 'TRUE',
+        'VSI_CACHE_SIZE': vsi_cache_size}
+
+    names = sorted(runtime_settings.keys())
+    profile = ''.join([
+        'export %s=%s\n' % (name, runtime_settings[name]) for name in names])
+    put(StringIO(profile), GDAL_RUNTIME_PROFILE, use_sudo=True, mode=0o644)
+
+    # mod_fcgid does not pass the apache environment on, so both are set
+    apache_conf = 'FcgidMaxProcesses %s\n' % processes
+    for name in names:
+        apache_conf += 'FcgidInitialEnv %s %s\n' % (
+            name, runtime_settings[name])
+        apache_conf += 'SetEnv %s %s\n' % (name, runtime_settings[name])
+    fabtools.require.deb.packages(['apache2', 'libapache2-mod-fcgid'])
+    put(StringIO(apache_conf),
+        '/etc/apache2/conf-available/fabgis-gdal.conf',
+        use_sudo=True,
+        mode=0o644)
+    sudo('a2enconf fabgis-gdal')
+    # Check if apache configs are ok - script will abort if not ok
+    sudo('/usr/sbin/apache2ctl configtest')
+    fabtools.require.service.restarted('apache2')
+    fastprint(green('GDAL runtime settings: %s\n' % runtime_settings))
+    return runtime_settings
@@ -4,16 +4,32 @@ Git related utilities.
 
 """
 import os
-from fabric.api import fastprint, run, cd, task, env
+import shutil
+import tempfile
+from string import hexdigits
+from fabric.api import (
+    fastprint, run, cd, task, env, hide, local, put, settings)
 from fabric.colors import red, cyan, green
 from fabric.contrib.files import exists
 import fabtools
 
 from .common import setup_env
 
+LOCAL_GIT_MIRRORS = os.path.join('fabgis_resources', 'mirrors')
+
 
 @task
-def update_git_checkout(code_path, url, repo_alias, branch='master', tag=None):
+def update_git_checkout(
+        code_path,
+        url,
+        repo_alias,
+        branch='master',
+        tag=None,
+        depth=None,
+        partial=False,
+        reference=None,
+        mirror=False,
+        bundle=False):
     """Make sure there is a read only git checkout.
 
     :param code_path: Path to where the repo should be checked out.
@@ -32,10 +48,47 @@ def update_git_checkout(code_path, url, repo_alias, branch='master', tag=None):
         used in preference to branch.
     :type tag: None, str
 
+    :param depth: If given, a new clone only gets this many commits of
+        history. Other branches and tags are fetched as they are needed.
+    :type depth: int
+
+    :param partial: Whether a new clone should be a blob-less partial clone
+        that downloads file contents only when they are checked out. Needs
+        git 2.19 or newer. Default False.
+    :type partial: bool
+
+    :param reference: Path on the remote host of a clone or mirror of the
+        same repo to borrow objects from (git clone --reference). It must
+        not be deleted while the checkout uses it.
+    :type reference: str
+
+    :param mirror: Whether to borrow objects from a mirror seeded from the
+        control host instead - see :func:`require_reference_mirror`.
+        Default False.
+    :type mirror: bool
+
+    :param bundle: Whether to update from a git bundle of the commits the
+        checkout is missing, made from a mirror on the control host, so the
+        remote host does not fetch from url itself. Default False.
+    :type bundle: bool
+
+    :returns: A dict with the 'old_head' and 'new_head' commits, whether
+        the checkout 'changed' and the 'files' that changed - see
+        :func:`parse_git_sync`.
+    :rtype: dict
+
+    :raises: Exception if the checkout could not be updated.
+
+    The whole update is a single remote command, so the cost of an up to
+    date checkout is one round trip.
+
     To run e.g.::
 
         fab -H foo:1234 remote update_git_checkout
 
+    .. versionchanged:: 0.18.0
+        depth, partial, reference, mirror and bundle parameters added and
+        the result is returned.
     """
     fastprint(cyan('Updating git checkout.\n'))
     fastprint(cyan('code_path: %s\n' % code_path))
@@ -46,39 +99,563 @@ def update_git_checkout(code_path, url, repo_alias, branch='master', tag=None):
     setup_env()
     repo_path = os.path.join(code_path, repo_alias)
 
-    fabtools.require.deb.package('git')
-    if not exists(repo_path):
-        fastprint(green('Repository does not exist, creating.\n'))
+    if bundle:
+        fabtools.require.deb.package('git')
         fabtools.require.directory(code_path, use_sudo=True, owner=env.user)
-        with cd(code_path):
-            run('git clone %s %s' % (url, repo_alias))
+        _fetch_from_bundle(url, repo_alias, repo_path)
+    elif mirror and not exists(repo_path):
+        reference = require_reference_mirror(url, repo_alias)
+
+    options = ''
+    if depth is not None:
+        # Keep all branches fetchable so they can be switched to later
+        options += '--depth %s --no-single-branch --branch %s ' % (
+            depth, tag or branch)
+    if partial:
+        options += '--filter=blob:none '
+    if tag is not None:
+        checkout = (
+            'git rev-parse -q --verify refs/tags/%(tag)s > /dev/null || '
+            '{ test -f .git/shallow && '
+            'git fetch -q --depth 1 origin tag %(tag)s; } ; '
+            'git rev-parse -q --verify refs/tags/%(tag)s > /dev/null || '
+            '{ echo "Unknown tag %(tag)s" >&2; exit 1; }; '
+            'git checkout -q %(tag)s' % {'tag': tag})
     else:
-        fastprint(green('Repo checkout does exist, updating.'))
-        with cd(repo_path):
-            # Get any updates first
-            run('git fetch')
-            if tag is not None:
-                tags = run('git tag --list')
-                if tag in tags:
-                    fastprint(green('Checking out tag.'))
-                    run('git checkout %s' % tag)
-                else:
-                    fastprint(red('Checking out tag failed - unknown tag.'))
-                    raise Exception('Git checkout failed for tag')
-
-            elif branch != 'master':
-                fastprint(green('Checking out branch.'))
-                branches = run('git branch')
-                if branch not in branches:
-                    print branches
-                    run('git branch --track %s origin/%s' % (branch, branch))
-                if ('* %s' % branch) not in branches:
-                    run('git checkout %s' % branch)
-            else:
-                fastprint(green('Checking out master.'))
-                run('git checkout master')
-            run('git pull')
-    fastprint(green('Checking out tag completed.'))
+        checkout = (
+            'git show-ref -q --verify refs/heads/%(branch)s || '
+            'git branch -q --track %(branch)s origin/%(branch)s; '
+            'git checkout -q %(branch)s && '
+            'git merge -q --ff-only origin/%(branch)s' % {'branch': branch})
+
+    # Everything happens in one remote call. Hosts without git or a usable
+    # code_path answer 'setup' and are retried once they have been set up.
+    script = (
+        'at_least() { printf "%%s\\n" $1 $(git --version | cut -d " " -f 3)'
+        ' | sort -V -C; }; '
+        'command -v git > /dev/null && mkdir -p %(code_path)s 2> /dev/null '
+        '&& test -w %(code_path)s || { echo "FABGIS-SYNC setup"; exit 0; }; '
+        'if [ ! -d %(repo_path)s/.git ]; then '
+        'options="%(options)s"; '
+        'if [ -n "%(partial)s" ] && ! at_least 2.19; then '
+        'echo "Partial clones need git 2.19 or newer" >&2; exit 1; fi; '
+        'if [ -n "%(reference)s" ]; then '
+        'if at_least 2.11; then options="$options --reference-if-able"; '
+        'else options="$options --reference"; fi; '
+        'options="$options %(reference)s"; fi; '
+        'cd %(code_path)s && git clone $options %(url)s %(repo_alias)s && '
+        'cd %(repo_alias)s && %(clone_checkout)s || exit 1; '
+        'old=none; '
+        'else '
+        'cd %(repo_path)s || exit 1; '
+        'old=$(git rev-parse -q --verify HEAD || echo none); '
+        '%(fetch)s'
+        '{ %(checkout)s; } || exit 1; '
+        'fi; '
+        'new=$(git rev-parse HEAD); '
+        'echo "FABGIS-SYNC $old $new"; '
+        'if [ "$old" != none ] && [ "$old" != "$new" ]; then '
+        'git diff --name-only $old $new | sed "s/^/FABGIS-FILE /"; fi' % {
+            'code_path': code_path,
+            'repo_path': repo_path,
+            'repo_alias': repo_alias,
+            'url': url,
+            'options': options,
+            'partial': 'yes' if partial else '',
+            'reference': reference or '',
+            'clone_checkout': 'git checkout -q %s' % (tag or branch),
+            'fetch': '' if bundle else 'git fetch -q || exit 1; ',
+            'checkout': checkout})
+
+    for attempt in range(2):
+        # A branch switch can list tens of thousands of changed files
+        with settings(warn_only=True), hide('output', 'warnings'):
+            output = run(script)
+        if output.failed:
+            fastprint(red('Updating %s failed:\n%s\n' % (
+                repo_alias, output)))
+            raise Exception('Git checkout failed for %s' % repo_alias)
+        if 'FABGIS-SYNC setup' not in output:
+            break
+        if attempt:
+            raise Exception('Can not check out %s in %s' % (
+                repo_alias, code_path))
+        fabtools.require.deb.package('git')
+        fabtools.require.directory(code_path, use_sudo=True, owner=env.user)
+
+    result = parse_git_sync(output)
+    if result['files'] is not None:
+        fastprint(green('%s files changed.\n' % len(result['files'])))
+    if result['changed']:
+        fastprint(green('%s is now at %s.\n' % (
+            repo_alias, result['new_head'])))
+    else:
+        fastprint(green('%s is unchanged at %s.\n' % (
+            repo_alias, result['new_head'])))
+    return result
+
+
+def parse_git_sync(output):
+    """Parse the report of a checkout update into a structured result.
+
+    The report has a ``FABGIS-SYNC <old> <new>`` line, where old is 'none'
+    for a new checkout, followed by a ``FABGIS-FILE <path>`` line for each
+    file that differs between the two commits.
+
+    :param output: Output of the remote update command.
+    :type output: str
+
+    :returns: A dict with the 'old_head' commit (None for a new checkout),
+        'new_head' commit, whether the checkout 'changed' and the 'files'
+        that changed (None for a new checkout).
+    :rtype: dict
+
+    .. versionadded:: 0.18.0
+    """
+    old_head = new_head = None
+    files = []
+    for line in output.splitlines():
+        parts = line.strip().split(' ', 1)
+        if parts[0] == 'FABGIS-SYNC' and len(parts) == 2:
+            old_head, new_head = parts[1].split()
+        elif parts[0] == 'FABGIS-FILE' and len(parts) == 2:
+            files.append(parts[1])
+    if new_head is None:
+        raise Exception('No git sync report in output')
+    if old_head == 'none':
+        old_head = None
+        files = None
+    return {
+        'old_head': old_head,
+        'new_head': new_head,
+        'changed': old_head != new_head,
+        'files': files}
+
+
+def require_reference_mirror(url, name):
+    """Make sure the remote host has a mirror of a repo to borrow objects from.
+
+    The mirror is kept in ~/dev/mirrors/<name>.git. The first time it is
+    seeded with a bundle of the control host mirror (see
+    :func:`update_local_mirror`) so the history crosses the network from the
+    control host rather than from upstream. After that it is updated from
+    upstream.
+
+    :param url: Complete url of the upstream repo.
+    :type url: str
+
+    :param name: Name of the mirror e.g. 'QGIS'.
+    :type name: str
+
+    :returns: Path of the mirror on the remote host.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    mirror_path = '%s/mirrors/%s.git' % (env.fg.workspace, name)
+    if exists(mirror_path):
+        run('git --git-dir=%s fetch --prune origin' % mirror_path)
+        return mirror_path
+
+    local_mirror = update_local_mirror(url, name)
+    bundle = os.path.join(LOCAL_GIT_MIRRORS, '%s.bundle' % name)
+    local('git --git-dir=%s bundle create %s --all' % (
+        local_mirror, os.path.abspath(bundle)))
+    remote_bundle = '/tmp/%s.bundle' % name
+    run('mkdir -p %s/mirrors' % env.fg.workspace)
+    put(bundle, remote_bundle)
+    run('git clone --mirror %s %s' % (remote_bundle, mirror_path))
+    run('rm %s' % remote_bundle)
+    run('git --git-dir=%s remote set-url origin %s' % (mirror_path, url))
+    return mirror_path
+
+
+def update_git_checkouts(repos, workers=3):
+    """Clone or update several read only git checkouts at the same time.
+
+    All the checkouts run concurrently in one remote shell, at most workers
+    at a time. Like :func:`update_git_checkout` a new repo is cloned and an
+    existing one is fetched, switched to its branch or tag and pulled.
+
+    :param repos: The repos, each a dict with the 'code_path', 'url',
+        'repo_alias' and optional 'branch' (default 'master') and 'tag'
+        arguments of :func:`update_git_checkout`.
+    :type repos: list
+
+    :param workers: Maximum number of concurrent checkouts. Default 3.
+    :type workers: int
+
+    :returns: A dict of repo_alias to a dict with the 'seconds' taken and
+        the 'bytes' the repo's .git dir grew by.
+    :rtype: dict
+
+    :raises: Exception if any of the checkouts failed.
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    fabtools.require.deb.package('git')
+    scripts = []
+    for repo in repos:
+        repo_path = os.path.join(repo['code_path'], repo['repo_alias'])
+        ref = repo.get('tag') or repo.get('branch', 'master')
+        fabtools.require.directory(
+            repo['code_path'], use_sudo=True, owner=env.user)
+        if repo.get('tag'):
+            update = 'git checkout -q %s' % ref
+        else:
+            update = 'git checkout -q %s && git pull -q' % ref
+        scripts.append(
+            'while [ $(jobs -rp | wc -l) -ge %(workers)s ]; do sleep 1; done; '
+            '(start=$(date +%%s); '
+            'before=$(du -sb %(path)s/.git 2> /dev/null | cut -f 1); '
+            '{ if [ -d %(path)s/.git ]; then '
+            'cd %(path)s && git fetch -q && %(update)s; '
+            'else git clone -q --branch %(ref)s %(url)s %(path)s; fi; } '
+            '> /tmp/fabgis-git-%(alias)s.log 2>&1; status=$?; '
+            'after=$(du -sb %(path)s/.git 2> /dev/null | cut -f 1); '
+            'end=$(date +%%s); '
+            'echo "FABGIS-REPO %(alias)s $status $((end - start)) '
+            '$((${after:-0} - ${before:-0}))") &' % {
+                'workers': workers,
+                'path': repo_path,
+                'update': update,
+                'ref': ref,
+                'url': repo['url'],
+                'alias': repo['repo_alias']})
+
+    with settings(warn_only=True):
+        result = run(' '.join(scripts) + ' wait')
+
+    timings = {}
+    failed = []
+    for line in result.splitlines():
+        parts = line.split()
+        if len(parts) != 5 or parts[0] != 'FABGIS-REPO':
+            continue
+        alias, status, seconds, size = parts[1:]
+        timings[alias] = {'seconds': int(seconds), 'bytes': int(size)}
+        if status == '0':
+            fastprint(green('%s: %s seconds, %.1f MB\n' % (
+                alias, seconds, int(size) / 1048576.0)))
+        else:
+            fastprint(red('%s failed after %s seconds, see '
+                          '/tmp/fabgis-git-%s.log\n' % (
+                              alias, seconds, alias)))
+            failed.append(alias)
+    if failed or len(timings) != len(repos):
+        raise Exception('Git checkout failed for %s' % ', '.join(
+            failed or [repo['repo_alias'] for repo in repos
+                       if repo['repo_alias'] not in timings]))
+    return timings
+
+
+def get_git_version():
+    """Get the version of git installed on the remote host.
+
+    :returns: Version as a tuple of ints e.g. (2, 7, 4).
+    :rtype: tuple
+    """
+    with hide('output'):
+        version = run('git --version')
+    version = version.strip().split(' ')[2]
+    return tuple([int(part) for part in version.split('.') if part.isdigit()])
+
+
+def git_worktrees_supported():
+    """Check whether the remote host's git can make worktrees (git 2.5+).
+
+    :rtype: bool
+
+    .. versionadded:: 0.18.0
+    """
+    fabtools.require.deb.package('git')
+    return get_git_version() >= (2, 5)
+
+
+@task
+def update_git_worktree(
+        store_path,
+        url,
+        worktree_path,
+        branch='master',
+        seed_path=None,
+        bundle=False):
+    """Make sure there is a worktree for a branch backed by a shared store.
+
+    All worktrees made from the same store share its objects, so each
+    branch can have its own checkout (and build dirs) without cloning the
+    repository again or switching branches inside a single checkout.
+
+    :param store_path: Path to the bare repository shared by the worktrees.
+        It is cloned from url if it does not exist.
+    :type store_path: str
+
+    :param url: Complete url for cloning the repo.
+    :type url: str
+
+    :param worktree_path: Path where the branch should be checked out.
+    :type worktree_path: str
+
+    :param branch: The name of the branch to check out. Defaults to
+        'master'.
+    :type branch: str
+
+    :param seed_path: Optional path of an existing checkout of the same
+        repo. A new store is cloned from it (hard linking its objects) and
+        then only fetches what it lacks from url.
+    :type seed_path: str
+
+    :param bundle: Whether to update the store from a git bundle made on
+        the control host instead of fetching from url - see
+        :func:`update_git_checkout`. Default False.
+    :type bundle: bool
+
+    :returns: The update result - see :func:`parse_git_sync`.
+    :rtype: dict
+
+    .. note:: Needs git 2.5 or newer.
+
+    .. versionadded:: 0.18.0
+    """
+    if not git_worktrees_supported():
+        raise Exception('git worktrees need git 2.5 or newer')
+    if not exists(store_path):
+        fastprint(green('Shared repository does not exist, creating.\n'))
+        fabtools.require.directory(
+            os.path.dirname(store_path), use_sudo=True, owner=env.user)
+        if seed_path is not None and exists('%s/.git' % seed_path):
+            fastprint(green('Seeding it from %s.\n' % seed_path))
+            run('git clone -q --bare %s %s' % (seed_path, store_path))
+            # Its remote branches too, so fetch knows their history is here
+            run('git --git-dir=%s fetch -q %s '
+                '"+refs/remotes/origin/*:refs/remotes/origin/*"' % (
+                    store_path, seed_path))
+            run('git --git-dir=%s remote set-url origin %s' % (
+                store_path, url))
+        elif not bundle:
+            run('git clone --bare %s %s' % (url, store_path))
+        if exists(store_path):
+            # Bare clones do not track the remote branches by default
+            run('git --git-dir=%s config remote.origin.fetch '
+                '"+refs/heads/*:refs/remotes/origin/*"' % store_path)
+    if bundle:
+        name = os.path.basename(store_path.rstrip('/'))
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        _fetch_from_bundle(url, name, store_path, bare=True)
+    with cd(store_path):
+        if not bundle:
+            run('git fetch --prune origin')
+        if not exists(worktree_path):
+            fastprint(green('Adding worktree for %s.\n' % branch))
+            run('git worktree prune')
+            run('git worktree add -B %s %s origin/%s' % (
+                branch, worktree_path, branch))
+            with cd(worktree_path):
+                output = run(
+                    'echo "FABGIS-SYNC none $(git rev-parse HEAD)"')
+            return parse_git_sync(output)
+    fastprint(green('Updating worktree for %s.\n' % branch))
+    with cd(worktree_path), hide('output'):
+        output = run(
+            'old=$(git rev-parse HEAD); '
+            'git merge -q --ff-only origin/%s || exit 1; '
+            'new=$(git rev-parse HEAD); '
+            'echo "FABGIS-SYNC $old $new"; '
+            'git diff --name-only $old $new | sed "s/^/FABGIS-FILE /"' % (
+                branch))
+    result = parse_git_sync(output)
+    fastprint(green('%s files changed.\n' % len(result['files'])))
+    return result
+
+
+def update_local_mirror(url, name):
+    """Create or update a bare mirror of a repository on the control host.
+
+    :param url: Complete url for cloning the repo.
+    :type url: str
+
+    :param name: Name of the mirror e.g. 'gdal'. The mirror is kept in
+        fabgis_resources/mirrors/<name>.git.
+    :type name: str
+
+    :returns: Local path of the mirror.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    path = os.path.join(LOCAL_GIT_MIRRORS, '%s.git' % name)
+    if not os.path.exists(path):
+        fastprint(green('Creating local mirror of %s.\n' % url))
+        local('git clone --bare %s %s' % (url, path))
+        # Only branches and tags - not e.g. github's pull request refs
+        local('git --git-dir=%s config remote.origin.fetch '
+              '"+refs/heads/*:refs/heads/*"' % path)
+        local('git --git-dir=%s config --add remote.origin.fetch '
+              '"+refs/tags/*:refs/tags/*"' % path)
+    local('git --git-dir=%s fetch --prune origin' % path)
+    return path
+
+
+def _fetch_from_bundle(url, name, repo_path, bare=False):
+    """Bring a remote checkout up to date with the control host mirror.
+
+    Only the commits the remote checkout does not have yet are bundled and
+    uploaded. The remote tracking branches and tags of the checkout are
+    updated from the bundle as if it had been fetched from url. With bare
+    set, repo_path is a bare repository such as a worktree store.
+
+    :returns: False if the checkout was already up to date.
+    :rtype: bool
+    """
+    mirror = update_local_mirror(url, name)
+    git_dir = repo_path if bare else '%s/.git' % repo_path
+    git = 'git --git-dir=%s' % git_dir
+    have = []
+    if exists(git_dir):
+        with hide('output'):
+            remote_refs = run(
+                '%s for-each-ref --format="%%(objectname)" '
+                'refs/remotes/origin refs/tags' % git)
+        for commit in set(remote_refs.split()):
+            # Commits the mirror does not know can not be excluded
+            with settings(warn_only=True), hide('everything'):
+                known = local('git --git-dir=%s cat-file -e %s^{commit}' % (
+                    mirror, commit), capture=True)
+            if known.succeeded:
+                have.append(commit)
+    exclude = ''
+    if have:
+        exclude = '--not %s' % ' '.join(have)
+    count = local('git --git-dir=%s rev-list --count --branches --tags %s' % (
+        mirror, exclude), capture=True)
+    if int(count) == 0 and have:
+        fastprint(green('%s is up to date with the local mirror.\n' % name))
+        return False
+
+    bundle = os.path.abspath(
+        os.path.join(LOCAL_GIT_MIRRORS, '%s-update.bundle' % name))
+    local('git --git-dir=%s bundle create %s --branches --tags %s' % (
+        mirror, bundle, exclude))
+    fastprint(green('Uploading %s bundle of %s commits (%.1f MB).\n' % (
+        name, count, os.path.getsize(bundle) / 1048576.0)))
+    remote_bundle = '/tmp/%s-update.bundle' % name
+    put(bundle, remote_bundle)
+    os.remove(bundle)
+    if not exists(git_dir):
+        run('git init -q %s%s' % ('--bare ' if bare else '', repo_path))
+        run('%s remote add origin %s' % (git, url))
+        if bare:
+            # Bare repositories do not track the remote branches by default
+            run('%s config remote.origin.fetch '
+                '"+refs/heads/*:refs/remotes/origin/*"' % git)
+    # No --prune: an incremental bundle only has the refs that moved
+    run('%s fetch -q %s "+refs/heads/*:refs/remotes/origin/*" '
+        '"+refs/tags/*:refs/tags/*"' % (git, remote_bundle))
+    run('%s remote set-head origin --auto > /dev/null 2>&1 || true' % git)
+    run('rm %s' % remote_bundle)
+    return True
+
+
+def _put_shallow_seed(url, name, ref, repo_path):
+    """Seed a remote checkout with a depth 1 clone of ref from a mirror.
+
+    Git bundles cannot carry shallow history, so the seed is a tarball of
+    the .git dir of a depth 1 fetch from the control host mirror. A tag is
+    kept as refs/tags/<ref> so the checkout can resolve it without asking
+    upstream, and the branch fabgis-pin points at the commit it names.
+    Returns that commit.
+    """
+    mirror = os.path.abspath(update_local_mirror(url, name))
+    commit = local('git --git-dir=%s rev-parse "%s^{commit}"' % (
+        mirror, ref), capture=True).strip()
+    with settings(warn_only=True), hide('everything'):
+        is_tag = local('git --git-dir=%s show-ref -q --verify refs/tags/%s' % (
+            mirror, ref), capture=True).succeeded
+    if is_tag:
+        # Annotated tags are not commits so they can not be a branch head
+        refspec = '+refs/tags/%s:refs/tags/%s' % (ref, ref)
+    else:
+        refspec = '+%s:refs/heads/fabgis-pin' % commit
+    seed_path = tempfile.mkdtemp()
+    seed_file = os.path.join(
+        LOCAL_GIT_MIRRORS, '%s-%s.tar.gz' % (name, ref.replace('/', '-')))
+    try:
+        local('git init -q --bare %s' % seed_path)
+        local('git --git-dir=%s fetch -q --depth 1 file://%s %s' % (
+            seed_path, mirror, refspec))
+        local('git --git-dir=%s update-ref refs/heads/fabgis-pin %s' % (
+            seed_path, commit))
+        local('tar czf %s -C %s .' % (seed_file, seed_path))
+    finally:
+        shutil.rmtree(seed_path)
+    remote_seed = '/tmp/%s' % os.path.basename(seed_file)
+    put(seed_file, remote_seed)
+    run('mkdir -p %s/.git' % repo_path)
+    run('tar xzf %s -C %s/.git' % (remote_seed, repo_path))
+    run('rm %s' % remote_seed)
+    with cd(repo_path):
+        run('git config core.bare false')
+        run('git remote add origin %s' % url)
+        run('git checkout -q --force fabgis-pin')
+    return commit
+
+
+@task
+def update_shallow_checkout(repo_path, url, ref, mirror_name=None):
+    """Make sure there is a depth 1 checkout of a pinned tag or commit.
+
+    Only the tree of the pinned ref is fetched, not the repository history.
+    Changing ref fetches just the new commit.
+
+    :param repo_path: Path to where the repo should be checked out.
+    :type repo_path: str
+
+    :param url: Complete url for fetching the repo.
+    :type url: str
+
+    :param ref: Tag or full commit hash to check out.
+    :type ref: str
+
+    :param mirror_name: If given, a new checkout is seeded from the control
+        host mirror of that name (see :func:`update_local_mirror`) instead
+        of fetching from url.
+    :type mirror_name: str
+
+    :returns: The commit hash that is checked out.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    fabtools.require.deb.package('git')
+    if not exists('%s/.git' % repo_path):
+        if mirror_name is not None:
+            fastprint(green('Seeding checkout from local mirror.\n'))
+            # The seed is already at ref, there is nothing to fetch
+            return _put_shallow_seed(url, mirror_name, ref, repo_path)
+        else:
+            run('git init -q %s' % repo_path)
+            with cd(repo_path):
+                run('git remote add origin %s' % url)
+    with cd(repo_path):
+        with hide('output'):
+            head = run('git rev-parse -q --verify HEAD || true').strip()
+            pinned = run(
+                'git rev-parse -q --verify "%s^{commit}" || true' % ref)
+        if head and head == pinned.strip():
+            fastprint(green('Checkout is already at %s.\n' % ref))
+            return head
+        if len(ref) == 40 and all(char in hexdigits for char in ref):
+            run('git fetch -q --depth 1 origin %s' % ref)
+        else:
+            # Keep the tag so the check above finds it next time
+            run('git fetch -q --depth 1 origin '
+                '"+refs/tags/%(ref)s:refs/tags/%(ref)s"' % {'ref': ref})
+        run('git checkout -q --force FETCH_HEAD')
+        with hide('output'):
+            return run('git rev-parse HEAD').strip()
 
 
 @task
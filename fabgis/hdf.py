@@ -9,23 +9,37 @@ import fabtools
 from fabric.contrib.files import exists
 from fabric.api import fastprint, run, cd, env, task, sudo, settings
 
-from .system import setup_ccache, get_processor_count
+from .system import (
+    require_ccache, get_build_jobs, ccache_statistics, tmpfs_build_dir)
 from .common import setup_env
 from .utilities import append_if_not_present
+from .debian import build_deb
+from .downloads import put_tarball
+from .history import build_history, build_phase, set_build_fact
 
 
 @task
-def build_hdf5(version='1.8.11'):
+def build_hdf5(version='1.8.11', ram_build=False, package=False):
     """Get proj4 from tarball and build it.
 
     :param version: hdf5 version to build. The version should be consistent
         with a downloadable tar file from the project web site. Default is
         the current stable release.
     :type version: str
+
+    :param ram_build: Whether to copy the sources to a tmpfs and build there
+        when the host has enough free memory - see
+        :func:`fabgis.system.tmpfs_build_dir`. Default False.
+    :type ram_build: bool
+
+    :param package: Whether to install the build as a fabgis-hdf5 .deb
+        and keep the .deb for other hosts - see
+        :func:`fabgis.debian.build_deb`. Default False.
+    :type package: bool
     """
     setup_env()
     fabtools.require.deb.package('build-essential')
-    setup_ccache()
+    require_ccache()
 
     code_base = '%s/cpp' % env.fg.workspace
     filename = 'hdf5-%s' % version
@@ -34,26 +48,43 @@ def build_hdf5(version='1.8.11'):
         filename)
     code_path = '%s/%s' % (code_base, filename)
 
-    if not exists(code_path):
-        fastprint('Extracted tarball does not exist, creating.')
-        with cd(code_base):
-            if exists('%s.tar.gz' % filename):
-                run('rm %s.tar.gz' % filename)
-            run('wget %s' % source_url)
-            run('tar xfz %s.tar.gz' % filename)
+    with build_history('hdf5', version=version):
+        with build_phase('fetch'):
+            if not exists(code_path):
+                fastprint('Extracted tarball does not exist, creating.')
+                put_tarball(source_url, code_base)
+                with cd(code_base):
+                    run('tar xfz %s.tar.gz' % filename)
 
-    processor_count = get_processor_count()
+        jobs, load = get_build_jobs('hdf5')
+        set_build_fact('jobs', jobs)
 
-    with cd(code_path):
-        # Dont fail if make clean does not work
+        with tmpfs_build_dir(
+                '%s-tmpfs' % code_path,
+                'hdf5',
+                copy_from=code_path,
+                enabled=ram_build) as build_path:
+            with cd(build_path), ccache_statistics('hdf5'):
+                # Dont fail if make clean does not work
+                with settings(warn_only=True):
+                    run('make clean')
+                with build_phase('configure'):
+                    run('./configure')
+                with build_phase('compile'):
+                    run('make -j %s -l %s' % (jobs, load))
+                with build_phase('install'):
+                    if package:
+                        build_deb(
+                            'hdf5', version, build_path,
+                            'HDF5 hierarchical data format library')
+                    else:
+                        sudo('make install')
+        if package:
+            # The package ships its own ld.so.conf.d entry
+            return
+        # Write to ld path too so libs are loaded nicely
+        ld_file = '/etc/ld.so.conf.d/usr_local_lib.conf'
         with settings(warn_only=True):
-            run('make clean')
-        run('./configure')
-        run('make -j %s' % processor_count)
-        sudo('make install')
-    # Write to ld path too so libs are loaded nicely
-    ld_file = '/etc/ld.so.conf.d/usr_local_lib.conf'
-    with settings(warn_only=True):
-        sudo('rm %s' % ld_file)
-    append_if_not_present(ld_file, '/usr/local/lib', use_sudo=True)
-    sudo('ldconfig')
+            sudo('rm %s' % ld_file)
+        append_if_not_present(ld_file, '/usr/local/lib', use_sudo=True)
+        sudo('ldconfig')
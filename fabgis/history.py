@@ -0,0 +1,299 @@
+# coding=utf-8
+"""
+Build timing history.
+=====================
+
+Every fabgis source build records how long each of its phases (fetch,
+configure, compile and install) took, together with its ccache hit rate,
+parallel job count and facts about the host, as one line of json in
+``fabgis_resources/build-history.jsonl`` on the control host.
+:func:`build_report` reads the history back to flag builds that got slower
+and to compare hosts.
+
+Builds record themselves like this::
+
+    with build_history('gdal', revision=revision):
+        with build_phase('configure'):
+            run('./configure')
+        with build_phase('compile'):
+            set_build_fact('jobs', jobs)
+            run('make -j %s' % jobs)
+
+"""
+import json
+import os
+import time
+from contextlib import contextmanager
+from fabric.api import task, run, env, fastprint, settings, hide
+from fabric.colors import red, green, blue
+from .system import get_ccache_stats, get_host_resources
+
+LOCAL_BUILD_HISTORY = os.path.join('fabgis_resources', 'build-history.jsonl')
+BUILD_PHASES = ['fetch', 'configure', 'compile', 'install']
+
+# Builds in progress, innermost last
+_active_builds = []
+
+
+def _get_host_facts():
+    """Get the facts about the remote host that affect build times."""
+    resources = get_host_resources()
+    with settings(warn_only=True), hide('output', 'warnings'):
+        release = run('lsb_release -ds 2> /dev/null').strip()
+        compiler = run('gcc -dumpfullversion -dumpversion 2> /dev/null')
+    return {
+        'host': env.host_string,
+        'cores': resources['cores'],
+        'memory': resources['total_memory'],
+        'os': release,
+        'gcc': compiler.strip()}
+
+
+@contextmanager
+def build_history(project, **details):
+    """Context manager recording a source build in the build history.
+
+    Opening a build for a project that is already being recorded reuses the
+    outer record, so a task and the build function it calls can both use
+    it. Failed builds are recorded with a 'failed' status.
+
+    :param project: Name of the project being built e.g. 'qgis'.
+    :type project: str
+
+    :param details: Anything else that identifies the build e.g. version,
+        profile or revision.
+    :type details: dict
+
+    :returns: The record, a dict which is written out at the end.
+    :rtype: dict
+
+    .. versionadded:: 0.18.0
+    """
+    for record in _active_builds:
+        if record['project'] == project:
+            record.update(details)
+            yield record
+            return
+
+    record = {
+        'project': project,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'phases': {},
+        'status': 'failed'}
+    record.update(details)
+    record.update(_get_host_facts())
+    before = get_ccache_stats()
+    start = time.time()
+    _active_builds.append(record)
+    try:
+        yield record
+        record['status'] = 'ok'
+    finally:
+        _active_builds.remove(record)
+        record['total'] = round(time.time() - start, 1)
+        after = get_ccache_stats()
+        hits = after['hits'] - before['hits']
+        misses = after['misses'] - before['misses']
+        if hits + misses:
+            record['ccache_hit_rate'] = round(
+                100.0 * hits / (hits + misses), 1)
+        _write_record(record)
+
+
+def _write_record(record):
+    """Append a finished build record to the build history."""
+    if not os.path.exists(os.path.dirname(LOCAL_BUILD_HISTORY)):
+        os.makedirs(os.path.dirname(LOCAL_BUILD_HISTORY))
+    with open(LOCAL_BUILD_HISTORY, 'a') as history_file:
+        history_file.write(json.dumps(record, sort_keys=True) + '\n')
+    fastprint(blue('%s build %s in %.0f seconds: %s\n' % (
+        record['project'], record['status'], record['total'], ', '.join([
+            '%s %.0fs' % (phase, record['phases'][phase])
+            for phase in BUILD_PHASES if phase in record['phases']]))))
+
+
+def record_build(project, started, phases, status='ok', **details):
+    """Record a build that was timed without :func:`build_history`.
+
+    This is for builds that run concurrently in one remote command, which
+    can not each be wrapped in build_history.
+
+    :param project: Name of the project built e.g. 'qgis'.
+    :type project: str
+
+    :param started: Time the build started, as from time.time().
+    :type started: float
+
+    :param phases: Seconds taken by each phase, see BUILD_PHASES.
+    :type phases: dict
+
+    :param status: 'ok' or 'failed'. Default 'ok'.
+    :type status: str
+
+    :param details: Anything else that identifies the build e.g. version,
+        profile or jobs.
+    :type details: dict
+
+    .. versionadded:: 0.18.0
+    """
+    record = {
+        'project': project,
+        'started': time.strftime(
+            '%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+        'phases': phases,
+        'total': round(sum(phases.values()), 1),
+        'status': status}
+    record.update(details)
+    record.update(_get_host_facts())
+    _write_record(record)
+
+
+@contextmanager
+def build_phase(name):
+    """Context manager timing a phase of the build being recorded.
+
+    Time spent in a phase more than once is added up. Does nothing when no
+    build is being recorded.
+
+    :param name: Name of the phase, one of BUILD_PHASES.
+    :type name: str
+
+    .. versionadded:: 0.18.0
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if _active_builds:
+            phases = _active_builds[-1]['phases']
+            phases[name] = round(
+                phases.get(name, 0) + time.time() - start, 1)
+
+
+def set_build_fact(name, value):
+    """Add a fact such as the job count to the build being recorded.
+
+    :param name: Name of the fact e.g. 'jobs'.
+    :type name: str
+
+    :param value: Value of the fact, anything json can store.
+
+    .. versionadded:: 0.18.0
+    """
+    if _active_builds:
+        _active_builds[-1][name] = value
+
+
+def read_build_history(project=None):
+    """Read the successful, uncached builds from the build history.
+
+    :param project: Only return builds of this project.
+    :type project: str
+
+    :returns: Build records, oldest first.
+    :rtype: list
+
+    .. versionadded:: 0.18.0
+    """
+    if not os.path.exists(LOCAL_BUILD_HISTORY):
+        return []
+    records = []
+    with open(LOCAL_BUILD_HISTORY) as history_file:
+        for line in history_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            # Failed builds and cache hits say nothing about build times
+            if record.get('status') != 'ok' or record.get('cached'):
+                continue
+            if project is not None and record['project'] != project:
+                continue
+            records.append(record)
+    records.sort(key=lambda record: record['started'])
+    return records
+
+
+def _median(values):
+    """Get the median of a non empty list of numbers."""
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+@task
+def build_report(project=None, threshold=20, window=5):
+    """Report build time regressions and compare build hosts.
+
+    For each project and host the latest build is compared phase by phase
+    with the median of the builds before it, and phases more than threshold
+    percent slower are flagged. Then the latest build of each project on
+    each host is listed, fastest first.
+
+    Only the local history is read so this can be run without -H.
+
+    :param project: Only report on this project e.g. 'qgis'.
+    :type project: str
+
+    :param threshold: Percentage slow down that counts as a regression.
+        Default 20.
+    :type threshold: int
+
+    :param window: Number of earlier builds to compare against. Default 5.
+    :type window: int
+
+    :returns: Number of regressions found.
+    :rtype: int
+
+    .. versionadded:: 0.18.0
+    """
+    threshold = float(threshold)
+    window = int(window)
+    runs = {}
+    for record in read_build_history(project):
+        runs.setdefault(
+            (record['project'], record['host']), []).append(record)
+
+    regressions = 0
+    for (name, host), records in sorted(runs.items()):
+        latest = records[-1]
+        earlier = records[-window - 1:-1]
+        if not earlier:
+            continue
+        for phase in BUILD_PHASES + ['total']:
+            if phase == 'total':
+                values = [record['total'] for record in earlier]
+                value = latest['total']
+            else:
+                values = [
+                    record['phases'][phase] for record in earlier
+                    if phase in record['phases']]
+                value = latest['phases'].get(phase)
+            if not values or value is None:
+                continue
+            baseline = _median(values)
+            if baseline and value > baseline * (1 + threshold / 100):
+                regressions += 1
+                fastprint(red(
+                    '%s on %s: %s took %.0fs, was %.0fs (+%.0f%%) at %s\n' % (
+                        name, host, phase, value, baseline,
+                        100 * (value - baseline) / baseline,
+                        latest['started'])))
+    if not regressions:
+        fastprint(green('No build time regressions.\n'))
+
+    projects = sorted(set([key[0] for key in runs]))
+    for name in projects:
+        latest_builds = [
+            records[-1] for key, records in runs.items() if key[0] == name]
+        latest_builds.sort(key=lambda record: record['total'])
+        fastprint(blue('%s:\n' % name))
+        for record in latest_builds:
+            fastprint(
+                '  %-30s %6.0fs  %2s cores %6s MB  jobs %-3s  '
+                'ccache %5s%%  %s\n' % (
+                    record['host'], record['total'], record['cores'],
+                    record['memory'], record.get('jobs', '-'),
+                    record.get('ccache_hit_rate', '-'), record['started']))
+    return regressions
@@ -9,17 +9,26 @@ import os
 from fabric.api import task, fastprint, env
 from fabric.colors import blue, green
 import fabtools
-from .system import setup_qt4_developer_tools, setup_ccache
-from .git import update_git_checkout
+from .system import setup_qt4_developer_tools, require_ccache
+from .git import update_git_checkout, update_git_checkouts
 from .qgis import install_qgis2
 
 
 @task
-def setup_inasafe():
-    """Setup requirements for InaSAFE."""
+def setup_inasafe(bundle=False):
+    """Setup requirements for InaSAFE.
+
+    :param bundle: Whether to update the checkouts from git bundles made on
+        the control host instead of fetching from github on the remote host
+        - see :func:`fabgis.git.update_git_checkout`.
+    :type bundle: bool
+
+    .. versionchanged:: 0.18.0
+        bundle parameter added.
+    """
     fastprint(blue('Setting up InaSAFE dependencies\n'))
     setup_qt4_developer_tools()
-    setup_ccache()
+    require_ccache()
     install_qgis2()
     fabtools.require.deb.packages([
         'pep8',
@@ -40,24 +49,27 @@ def setup_inasafe():
     ])
     code_path = os.path.join('/home', env.user, 'dev', 'python')
 
-    update_git_checkout(
-        code_path=code_path,
-        url='git://github.com/AIFDR/inasafe.git',
-        repo_alias='inasafe-dev',
-        branch='master'
-    )
-    update_git_checkout(
-        code_path=code_path,
-        url='git://github.com/AIFDR/inasafe_data.git',
-        repo_alias='inasafe_data',
-        branch='master'
-    )
-    update_git_checkout(
-        code_path=code_path,
-        url='git://github.com/AIFDR/inasafe-doc.git',
-        repo_alias='inasafe-doc',
-        branch='develop'
-    )
+    repos = [
+        {'code_path': code_path,
+         'url': 'git://github.com/AIFDR/inasafe.git',
+         'repo_alias': 'inasafe-dev',
+         'branch': 'master'},
+        {'code_path': code_path,
+         'url': 'git://github.com/AIFDR/inasafe_data.git',
+         'repo_alias': 'inasafe_data',
+         'branch': 'master'},
+        {'code_path': code_path,
+         'url': 'git://github.com/AIFDR/inasafe-doc.git',
+         'repo_alias': 'inasafe-doc',
+         'branch': 'develop'},
+    ]
+    if bundle:
+        # Bundles are made and uploaded from the control host one by one
+        for repo in repos:
+            update_git_checkout(bundle=True, **repo)
+    else:
+        # The checkouts are independent and inasafe_data is large
+        update_git_checkouts(repos)
     fastprint(green('Setting up InaSAFE dependencies completed.\n'))
     fastprint(green('You should now have checkouts of inasafe-dev, \n'))
     fastprint(green('inasafe_data and insafe-doc in your dev/python dir.\n'))
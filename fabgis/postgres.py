@@ -4,14 +4,24 @@ Postgres related fabric tasks.
 ==============================
 
 """
+import hashlib
 import os
+import socket
+import time
+from distutils.spawn import find_executable
+from pipes import quote
 import fabtools
 from fabric.contrib.files import exists
 from fabtools.postgres import create_user
-from fabric.colors import red, green, blue
-from fabric.api import run, cd, env, task, sudo, get, put, fastprint
+from fabric.colors import red, green, blue, yellow
+from fabric.api import (
+    run, cd, env, task, sudo, get, put, fastprint, local)
+from fabric.state import connections
 from .common import setup_env, show_environment, add_ubuntugis_ppa
 from .utilities import replace_tokens
+from .system import get_build_jobs, ephemeral_swap
+from .downloads import put_tarball
+from .history import build_history, build_phase, set_build_fact
 
 
 @task
@@ -149,13 +159,22 @@ def setup_postgis_latest():
         source_url = ('http://download.osgeo.org/postgis/source/'
                       'postgis-2.1.1.tar.gz')
         source = 'postgis-2.1.1'
-        if not fabtools.files.is_file('%s.tar.gz' % source):
-            run('wget %s' % source_url)
-            run('tar xfz %s.tar.gz' % source)
-        with cd(source):
-            run('./configure')
-            run('make')
-            sudo('make install')
+        with build_history('postgis', version='2.1.1'):
+            # The ssh login dir is not env.fg.home when connecting as root
+            with cd(env.fg.home):
+                with build_phase('fetch'):
+                    put_tarball(source_url, env.fg.home)
+                    if not exists(source):
+                        run('tar xfz %s.tar.gz' % source)
+                jobs, load = get_build_jobs('postgis')
+                set_build_fact('jobs', jobs)
+                with cd(source):
+                    with build_phase('configure'):
+                        run('./configure')
+                    with build_phase('compile'):
+                        run('make -j %s -l %s' % (jobs, load))
+                    with build_phase('install'):
+                        sudo('make install')
 
     create_postgis_2_template()
 
@@ -189,13 +208,22 @@ def setup_postgis_1_5():
         source_url = ('http://download.osgeo.org/postgis/source/'
                       'postgis-1.5.8.tar.gz')
         source = 'postgis-1.5.8'
-        if not fabtools.files.is_file('%s.tar.gz' % source):
-            run('wget %s' % source_url)
-            run('tar xfz %s.tar.gz' % source)
-        with cd(source):
-            run('./configure')
-            run('make')
-            sudo('make install')
+        with build_history('postgis', version='1.5.8'):
+            # The ssh login dir is not env.fg.home when connecting as root
+            with cd(env.fg.home):
+                with build_phase('fetch'):
+                    put_tarball(source_url, env.fg.home)
+                    if not exists(source):
+                        run('tar xfz %s.tar.gz' % source)
+                jobs, load = get_build_jobs('postgis')
+                set_build_fact('jobs', jobs)
+                with cd(source):
+                    with build_phase('configure'):
+                        run('./configure')
+                    with build_phase('compile'):
+                        run('make -j %s -l %s' % (jobs, load))
+                    with build_phase('install'):
+                        sudo('make install')
 
     create_postgis_1_5_template()
 
@@ -249,8 +277,96 @@ def create_postgis_1_5_db(dbname, user):
     run('psql %s -c "%s"' % (dbname, grant_sql))
 
 
+def stream_to_local_file(command, local_path, checksum=False):
+    """Stream the output of a remote command into a local file.
+
+    The output is read straight from the ssh channel and written to the
+    file as it arrives, so nothing is staged on the remote host and the
+    transfer overlaps with the command. Progress is reported every few
+    seconds. The command runs under a plain /bin/sh rather than env.shell
+    so login scripts cannot write into the stream, and its stderr is
+    drained while streaming so a chatty command cannot stall the channel.
+
+    :param command: Shell command to run on the remote host.
+    :type command: str
+
+    :param local_path: Path of the file on the control host. It is written
+        as <local_path>.part and only renamed once the command succeeded.
+    :type local_path: str
+
+    :param checksum: Whether to write the sha256 of the stream to
+        <local_path>.sha256. Default False.
+    :type checksum: bool
+
+    :returns: A tuple of the number of bytes written and the hex sha256
+        (None unless checksum is set).
+    :rtype: tuple
+
+    :raises: Exception if the remote command failed.
+
+    .. versionadded:: 0.18.0
+    """
+    local_dir = os.path.dirname(local_path)
+    if local_dir and not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+    partial_path = '%s.part' % local_path
+    digest = hashlib.sha256() if checksum else None
+    size = 0
+    start = last_report = time.time()
+
+    channel = connections[env.host_string].get_transport().open_session()
+    channel.exec_command('/bin/sh -c %s' % quote(command))
+    channel.settimeout(1)
+    errors = []
+    try:
+        with open(partial_path, 'wb') as local_file:
+            while True:
+                while channel.recv_stderr_ready():
+                    errors.append(channel.recv_stderr(65536))
+                try:
+                    block = channel.recv(1024 * 1024)
+                except socket.timeout:
+                    continue
+                if not block:
+                    break
+                local_file.write(block)
+                if digest is not None:
+                    digest.update(block)
+                size += len(block)
+                if time.time() - last_report > 5:
+                    last_report = time.time()
+                    fastprint(blue('%.0f MB at %.1f MB/s\n' % (
+                        size / 1048576.0,
+                        size / 1048576.0 / (last_report - start))))
+        status = channel.recv_exit_status()
+        errors.append(channel.makefile_stderr().read())
+    finally:
+        channel.close()
+    if status != 0:
+        os.remove(partial_path)
+        raise Exception('%s failed (%s): %s' % (
+            command, status, ''.join(errors)))
+    os.rename(partial_path, local_path)
+
+    elapsed = max(time.time() - start, 0.001)
+    fastprint(green('Wrote %s: %.1f MB in %.0f seconds (%.1f MB/s)\n' % (
+        local_path, size / 1048576.0, elapsed, size / 1048576.0 / elapsed)))
+    if digest is None:
+        return size, None
+    with open('%s.sha256' % local_path, 'w') as checksum_file:
+        checksum_file.write('%s  %s\n' % (
+            digest.hexdigest(), os.path.basename(local_path)))
+    fastprint(green('sha256 %s\n' % digest.hexdigest()))
+    return size, digest.hexdigest()
+
+
 @task
-def get_postgres_dump(dbname, ignore_permissions=False, file_name=None):
+def get_postgres_dump(
+        dbname,
+        ignore_permissions=False,
+        file_name=None,
+        stream=False,
+        checksum=False):
     """Get a dump of the database from the server.
 
     :param dbname: name of the database to restore the dump into.
@@ -266,9 +382,44 @@ def get_postgres_dump(dbname, ignore_permissions=False, file_name=None):
         where date is in the form dd-mm-yyyy. This is the default naming
         convention used by the :func:`restore_postgres_dump` function below.
     :type file_name: str
+
+    :param stream: Whether to stream the dump over ssh straight into the
+        local file instead of writing it to /tmp on the server and then
+        downloading it - see :func:`stream_to_local_file`. The streamed
+        dump is checked with pg_restore -l when pg_restore is available on
+        the control host. Default False.
+    :type stream: bool
+
+    :param checksum: Whether to write a .sha256 file next to a streamed
+        dump. Default False.
+    :type checksum: bool
+
+    .. versionchanged:: 0.18.0
+        stream and checksum parameters added.
     """
     setup_env()
 
+    if stream:
+        if file_name is None or file_name == '':
+            date = run('date +%d-%B-%Y')
+            my_file = '%s-%s.dmp' % (dbname, date)
+        else:
+            my_file = os.path.split(file_name)[1]
+        extra_args = '-x -O' if ignore_permissions else ''
+        local_path = 'fabgis_resources/sql/dumps/%s' % my_file
+        stream_to_local_file(
+            'pg_dump %s -Fc %s' % (extra_args, dbname),
+            local_path,
+            checksum=checksum)
+        # A custom format dump that pg_restore can list is complete
+        if find_executable('pg_restore'):
+            local('pg_restore -l %s > /dev/null' % quote(local_path))
+        else:
+            fastprint(yellow(
+                'pg_restore not found locally, %s was not verified\n' %
+                local_path))
+        return
+
     if file_name is None or file_name == '':
         date = run('date +%d-%B-%Y')
         my_file = '%s-%s.dmp' % (dbname, date)
@@ -357,12 +508,16 @@ def restore_postgres_dump(
 
 
 @task
-def compile_osm2pgsql():
+def compile_osm2pgsql(swap=True):
     """From-source compile of osm2pgsql.
 
     We build from source so we can use recent postgresql packages.
 
     See: http://wiki.openstreetmap.org/wiki/Osm2pgsql#From_source
+
+    :param swap: Whether to add temporary swap if the build may not fit in
+        memory - see :func:`fabgis.system.ephemeral_swap`. Default True.
+    :type swap: bool
     """
     add_ubuntugis_ppa()
     fabtools.require.deb.packages([
@@ -382,15 +537,23 @@ def compile_osm2pgsql():
         'liblua5.2-dev',
         'liblua5.1-0',
     ])
-    with cd('/tmp'):
-        if not exists('osm2pgsql'):
-            run('git clone https://github.com/openstreetmap/osm2pgsql.git')
-
-    with cd('/tmp/osm2pgsql'):
-        run('./autogen.sh')
-        run('./configure')
-        run('make -j4')
-        sudo('make install')
+    with build_history('osm2pgsql'):
+        with cd('/tmp'), build_phase('fetch'):
+            if not exists('osm2pgsql'):
+                run('git clone '
+                    'https://github.com/openstreetmap/osm2pgsql.git')
+
+        jobs, load = get_build_jobs('osm2pgsql')
+        set_build_fact('jobs', jobs)
+        with cd('/tmp/osm2pgsql'):
+            with build_phase('configure'):
+                run('./autogen.sh')
+                run('./configure')
+            with build_phase('compile'), \
+                    ephemeral_swap('osm2pgsql', jobs, enabled=swap):
+                run('make -j %s -l %s' % (jobs, load))
+            with build_phase('install'):
+                sudo('make install')
 
 
 @task
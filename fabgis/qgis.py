@@ -5,22 +5,36 @@ QGIS related build tools.
 
 """
 import os
+import time
+from pipes import quote
+from StringIO import StringIO
 from fabric.contrib.files import exists
-from fabric.api import run, cd, env, task, sudo, fastprint
-from fabric.colors import green
+from fabric.api import (
+    run, cd, env, task, sudo, fastprint, hide, put, settings, shell_env)
+from fabric.colors import green, red
 from fabtools import require
 from fabric.contrib.files import upload_template
 import fabtools
 from .common import add_ubuntugis_ppa
 from .common import setup_env
-from .git import update_git_checkout
-from .system import setup_ccache, get_processor_count
+from .git import (
+    update_git_checkout, update_git_worktree, git_worktrees_supported)
+from .system import (
+    require_ccache, ccache_statistics, tmpfs_build_dir, get_host_resources,
+    ephemeral_swap, get_build_jobs, resolve_march, BUILD_JOB_MEMORY)
 from .gdal import build_gdal
+from .cmake import (
+    require_cmake_generator, cmake_options, cmake_build_command)
+from .distcc import distcc_jobs
+from .history import (
+    build_history, build_phase, set_build_fact, record_build)
+from .artifacts import (
+    artifact_key, get_build_facts, fetch_artifact, store_artifact)
 from .postgres import create_postgis_1_5_db
 
 
 @task
-def clone_qgis(branch='master', delete_local_branches=False):
+def clone_qgis(branch='master', delete_local_branches=False, bundle=False):
     """Clone or update QGIS from git.
 
     :param branch: Name of the branch to build from. Defaults to 'master'
@@ -29,9 +43,19 @@ def clone_qgis(branch='master', delete_local_branches=False):
     :param delete_local_branches: Whether existing local branches should be
         pruned away from git.
     :type delete_local_branches: bool
+
+    :param bundle: Whether to update from a git bundle made on the control
+        host instead of fetching from github on the remote host - see
+        :func:`fabgis.git.update_git_checkout`.
+    :type bundle: bool
+
+    :returns: The update result - see :func:`fabgis.git.parse_git_sync`.
+    :rtype: dict
+
+    .. versionchanged:: 0.18.0
+        bundle parameter added and the update result is returned.
     """
     setup_env()
-    fabtools.require.deb.package('git')
     # Add this to the users git config so that we don't get repeated
     # authentication requests when using ssl
     #run('git config --global credential.helper \'cache --timeout=3600\'')
@@ -40,18 +64,269 @@ def clone_qgis(branch='master', delete_local_branches=False):
     code_base = '%s/cpp' % env.fg.workspace
     code_path = '%s/QGIS' % code_base
 
-    update_git_checkout(
+    sync = update_git_checkout(
         code_base,
         env.fg.qgis_git_url,
         'QGIS',
-        branch)
-    if exists(code_path):
+        branch,
+        bundle=bundle)
+    if delete_local_branches:
         with cd(code_path):
-            if delete_local_branches:
-                run('git branch | grep -v \* | xargs git branch -D')
+            run('git branch | grep -v \* | xargs git branch -D')
+    return sync
+
+
+# Named build profiles for compile_qgis. Debug builds keep the historical
+# install prefix (/usr/local/qgis-<version>) while every other profile is
+# installed side by side under /usr/local/qgis-<version>-<profile>.
+QGIS_BUILD_PROFILES = {
+    'debug': {
+        'build_type': 'Debug',
+        'cxx_flags': '',
+        'linker_flags': ''},
+    'release': {
+        'build_type': 'Release',
+        'cxx_flags': '',
+        'linker_flags': ''},
+    'relwithdebinfo': {
+        'build_type': 'RelWithDebInfo',
+        'cxx_flags': '',
+        'linker_flags': ''},
+    'lto': {
+        'build_type': 'Release',
+        'cxx_flags': '-march=%(march)s -flto',
+        'linker_flags': '-flto'},
+    # Profile guided optimisation - see build_qgis_server_pgo. Both phases
+    # must use the same build dir so gcc can match profiles to objects.
+    'pgo-generate': {
+        'build_type': 'Release',
+        'cxx_flags': '-march=%(march)s -fprofile-generate=%(profile_dir)s',
+        'linker_flags': '-fprofile-generate=%(profile_dir)s'},
+    'pgo': {
+        'build_type': 'Release',
+        'cxx_flags': (
+            '-march=%(march)s -fprofile-use=%(profile_dir)s '
+            '-fprofile-correction -Wno-coverage-mismatch'),
+        'linker_flags': ''},
+    # Just qgis_mapserv.fcgi and the libraries it needs, stripped. QGIS 2
+    # ignores the options it does not know (e.g. WITH_DESKTOP).
+    'server': {
+        'build_type': 'Release',
+        'cxx_flags': '',
+        'linker_flags': '',
+        'cmake_options': (
+            '-DWITH_SERVER=ON '
+            '-DWITH_DESKTOP=OFF '
+            '-DWITH_BINDINGS=OFF '
+            '-DWITH_SERVER_PLUGINS=OFF '
+            '-DWITH_GRASS7=OFF '
+            '-DWITH_GLOBE=OFF '
+            '-DWITH_QTWEBKIT=OFF '
+            '-DWITH_CUSTOM_WIDGETS=OFF '
+            '-DWITH_APIDOC=OFF '
+            '-DWITH_ASTYLE=OFF '
+            '-DENABLE_TESTS=OFF '),
+        'install_target': 'install/strip'},
+}
+
+# Build dependencies of the server profile, instead of apt-get build-dep.
+# QGIS 2 always builds the gui library so qscintilla and qwt are needed.
+QGIS_SERVER_PACKAGES = [
+    'build-essential',
+    'cmake',
+    'flex',
+    'bison',
+    'libqt4-dev',
+    'libgdal1-dev',
+    'libgeos-dev',
+    'libproj-dev',
+    'libsqlite3-dev',
+    'libspatialite-dev',
+    'libspatialindex-dev',
+    'libexpat1-dev',
+    'libpq-dev',
+    'libqwt-dev',
+    'libqscintilla2-dev',
+    'libfcgi-dev',
+]
+
+# QGIS versions fabgis knows how to build: git branch and build dir name.
+QGIS_VERSIONS = {
+    '1.8': ('release-1_8', 'build-qgis18-fabgis'),
+    '2.0': ('release-2_0', 'build-qgis2-fabgis'),
+    '2.2': ('release-2_2', 'build-qgis2_2-fabgis'),
+    'master': ('master', 'build-master-fabgis'),
+}
+
+
+def get_qgis_prefix(qgis_version, profile='debug'):
+    """Get the install prefix for a QGIS version built with a given profile.
+
+    :param qgis_version: QGIS version e.g. '2.0' or 'master'.
+    :type qgis_version: str
+
+    :param profile: Name of the build profile (see QGIS_BUILD_PROFILES).
+    :type profile: str
+
+    :returns: Path the QGIS binaries are installed to e.g.
+        /usr/local/qgis-2.0-release
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    if profile not in QGIS_BUILD_PROFILES:
+        raise Exception('Unknown QGIS build profile: %s' % profile)
+    if profile == 'debug':
+        return '/usr/local/qgis-%s' % qgis_version
+    return '/usr/local/qgis-%s-%s' % (qgis_version, profile)
+
 
+def update_qgis_worktree(branch='master', bundle=False):
+    """Check out a QGIS branch in its own worktree.
+
+    All branches share one object store in ~/dev/cpp/QGIS.git and each one
+    is checked out to ~/dev/cpp/QGIS-<branch>, so updating one branch never
+    touches the files (and make timestamps) of another.
+
+    :param branch: Name of the branch to check out. Defaults to 'master'.
+    :type branch: str
+
+    :param bundle: Whether to update the sources from a git bundle made
+        on the control host instead of fetching from github on the remote
+        host - see :func:`fabgis.git.update_git_checkout`. Default False.
+    :type bundle: bool
+
+    :returns: A tuple of the path to the worktree and the update result -
+        see :func:`fabgis.git.parse_git_sync`.
+    :rtype: tuple
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    code_base = '%s/cpp' % env.fg.workspace
+    worktree_path = '%s/QGIS-%s' % (code_base, branch)
+    # Reuse the history of an existing clone_qgis checkout
+    sync = update_git_worktree(
+        '%s/QGIS.git' % code_base,
+        env.fg.qgis_git_url,
+        worktree_path,
+        branch,
+        seed_path='%s/QGIS' % code_base,
+        bundle=bundle)
+    return worktree_path, sync
+
+
+def qgis_cmake_command(
+        build_path,
+        build_prefix,
+        gdal_from_source=False,
+        profile='debug',
+        march='native',
+        generator='make',
+        pch=False,
+        unity=False,
+        clean=True,
+        distributed=False,
+        ram_build=False):
+    """Prepare a QGIS build dir and get the cmake command to configure it.
+
+    Build dependencies are installed, the build dir and install prefix are
+    created (and GDAL built if requested) but cmake itself is not run. The
+    parameters are as for :func:`compile_qgis`.
+
+    :returns: The cmake command to run inside build_path.
+    :rtype: str
 
-def compile_qgis(build_path, build_prefix, gdal_from_source=False):
+    .. versionadded:: 0.18.0
+    """
+    if profile not in QGIS_BUILD_PROFILES:
+        raise Exception('Unknown QGIS build profile: %s' % profile)
+    build_profile = QGIS_BUILD_PROFILES[profile]
+
+    if profile != 'server':
+        fabtools.require.deb.package('cmake-curses-gui')
+        fabtools.require.deb.package('grass-dev')
+        fabtools.require.deb.package('grass')
+        fabtools.require.deb.package('python-gdal')
+    fabtools.require.deb.package('git')
+    fabtools.require.deb.package('libfcgi-dev')
+    require_cmake_generator(generator)
+    # Ensure we have a clean build dir unless rebuilding incrementally
+    if clean and exists(build_path):
+        run('rm -rf %s' % build_path)
+    fabtools.require.directory(build_path)
+    fabtools.require.directory(
+        build_prefix,
+        use_sudo=True,
+        owner=env.fg.user)
+    os_version = run('cat /etc/issue.net')
+    os_version = float(os_version.split(' ')[1].split('.')[0])
+
+    if os_version >= 13:
+        extra = (
+            '-DPYTHON_LIBRARY=/usr/lib/x86_64-linux-gnu/libpython2.7.so ')
+    else:
+        extra = ''
+
+    if gdal_from_source:
+        # see that task for ecw and mrsid support
+        build_gdal(distributed=distributed, ram_build=ram_build)
+        extra += '-DGDAL_CONFIG=/usr/local/bin/gdal-config '
+
+    if distributed and '%(march)s' in build_profile['cxx_flags']:
+        # Each distcc worker would take -march=native as its own CPU
+        march = resolve_march(march)
+    flag_values = {
+        'march': march,
+        'profile_dir': '%s-pgo-data' % build_path.rstrip('/')}
+    cxx_flags = build_profile['cxx_flags'] % flag_values
+    linker_flags = build_profile['linker_flags'] % flag_values
+    if cxx_flags:
+        extra += (
+            '-DCMAKE_C_FLAGS="%(flags)s" '
+            '-DCMAKE_CXX_FLAGS="%(flags)s" ' % {'flags': cxx_flags})
+    if linker_flags:
+        extra += (
+            '-DCMAKE_EXE_LINKER_FLAGS="%(flags)s" '
+            '-DCMAKE_SHARED_LINKER_FLAGS="%(flags)s" '
+            '-DCMAKE_MODULE_LINKER_FLAGS="%(flags)s" '
+            % {'flags': linker_flags})
+    if '-flto' in linker_flags:
+        # Static helper libs need the lto aware archiver
+        extra += (
+            '-DCMAKE_AR=/usr/bin/gcc-ar '
+            '-DCMAKE_RANLIB=/usr/bin/gcc-ranlib ')
+
+    extra += build_profile.get('cmake_options', '')
+    extra += cmake_options(
+        os.path.dirname(build_path.rstrip('/')), generator, pch, unity)
+
+    return (
+        'cmake .. '
+        '-DCMAKE_INSTALL_PREFIX=%s '
+        '-DCMAKE_CXX_COMPILER:FILEPATH=/usr/local/bin/g++ '
+        '-DQT_QMAKE_EXECUTABLE=/usr/bin/qmake-qt4 '
+        '-DWITH_MAPSERVER=ON '
+        '-DWITH_INTERNAL_SPATIALITE=ON '
+        '-DWITH_GRASS=OFF '
+        '-DCMAKE_BUILD_TYPE=%s '
+        '%s'
+        % (build_prefix, build_profile['build_type'], extra))
+
+
+def compile_qgis(
+        build_path,
+        build_prefix,
+        gdal_from_source=False,
+        profile='debug',
+        march='native',
+        generator='make',
+        pch=False,
+        unity=False,
+        distributed=False,
+        ram_build=False,
+        clean=True,
+        swap=True):
     """Compile QGIS including installation of built tools and dependencies.
 
 
@@ -67,53 +342,507 @@ def compile_qgis(build_path, build_prefix, gdal_from_source=False):
     :param gdal_from_source: Whether gdal should be built from source.
         Default False.
     :type gdal_from_source: bool
+
+    :param profile: Name of the build profile to use. One of 'debug',
+        'release', 'relwithdebinfo', 'lto' or 'server' (only the map server,
+        no desktop, python bindings, GRASS or plugins). Default 'debug'.
+    :type profile: str
+
+    :param march: Architecture passed to -march for profiles that tune for
+        the cpu (currently 'lto' and the pgo profiles). Use 'native' only
+        when the binaries will run on the build host's cpu type. For a
+        distributed build 'native' is resolved to the build host's cpu
+        first. Default 'native'.
+    :type march: str
+
+    :param generator: The cmake generator to use - 'make' or 'ninja'.
+        Default 'make'.
+    :type generator: str
+
+    :param pch: Whether precompiled headers should be used where the QGIS
+        cmake supports them. Default False.
+    :type pch: bool
+
+    :param unity: Whether to do a cmake unity build. Default False.
+    :type unity: bool
+
+    :param distributed: Whether to spread the compile over the distcc farm
+        set up with :func:`fabgis.distcc.setup_distcc_farm`. Falls back to
+        a local build if no workers are reachable. Default False.
+    :type distributed: bool
+
+    :param ram_build: Whether the build dir should be a tmpfs when the host
+        has enough free memory - see :func:`fabgis.system.tmpfs_build_dir`.
+        The tmpfs is mounted over build_path and discarded afterwards, so
+        it is only used for clean builds; an incremental build (clean=False)
+        stays on disk. Default False.
+    :type ram_build: bool
+
+    :param clean: Whether an existing build dir should be removed first.
+        Pass False for an incremental rebuild. Default True.
+    :type clean: bool
+
+    :param swap: Whether to add temporary swap if the build may not fit in
+        memory - see :func:`fabgis.system.ephemeral_swap`. Default True.
+    :type swap: bool
+
+    :returns: Wall clock seconds taken to configure, build and install.
+    :rtype: float
+
+    .. note:: The 'pgo-generate' and 'pgo' profiles keep their profile data
+        in ``<build_path>-pgo-data`` which survives the build dir being
+        cleaned between the two phases.
+
+    .. versionchanged:: 0.18.0
+        profile, march, generator, pch, unity, distributed, ram_build, clean
+        and swap parameters added.
     """
+    if ram_build and not clean:
+        # A tmpfs over build_path would hide the objects we want to reuse
+        # and cmake build dirs can not be copied to another path.
+        fastprint(red(
+            'Incremental builds reuse %s on disk, not building in RAM.\n' %
+            build_path))
+    cmake = qgis_cmake_command(
+        build_path,
+        build_prefix,
+        gdal_from_source=gdal_from_source,
+        profile=profile,
+        march=march,
+        generator=generator,
+        pch=pch,
+        unity=unity,
+        clean=clean,
+        distributed=distributed,
+        ram_build=ram_build)
+    with build_history('qgis', profile=profile, generator=generator), \
+            cd(build_path):
+        start = time.time()
+        with tmpfs_build_dir(
+                build_path, 'qgis', enabled=ram_build and clean), \
+                ccache_statistics('QGIS'):
+            with build_phase('configure'):
+                run(cmake)
+            with distcc_jobs('qgis', distributed) as (jobs, load):
+                set_build_fact('jobs', jobs)
+                # Only the local jobs use local memory, not distcc ones
+                local_jobs, _ = get_build_jobs('qgis')
+                with build_phase('compile'), \
+                        ephemeral_swap(
+                            'qgis', min(jobs, local_jobs), enabled=swap):
+                    run('time %s' % cmake_build_command(
+                        generator, jobs, target='all', load=load))
+                with build_phase('install'):
+                    run(cmake_build_command(
+                        generator,
+                        jobs,
+                        target=QGIS_BUILD_PROFILES[profile].get(
+                            'install_target', 'install'),
+                        load=load))
+        elapsed = time.time() - start
+    fastprint(green('QGIS %s build took %.0f seconds\n' % (
+        generator, elapsed)))
+    return elapsed
+
+
+# Written to the build dir after an install, see install_qgis
+QGIS_INSTALL_STAMP = 'fabgis-installed'
+
+# Packages whose versions change what a QGIS build links against.
+QGIS_ARTIFACT_PACKAGES = [
+    'libgdal-dev',
+    'libgeos-dev',
+    'libproj-dev',
+    'libqt4-dev',
+    'libqscintilla2-dev',
+    'libqwt-dev',
+    'libspatialindex-dev',
+    'libspatialite-dev',
+    'libfcgi-dev',
+    'python-sip-dev',
+    'python-qt4-dev',
+]
+
+
+def qgis_artifact_key(build_path, profile='debug', march='native',
+                      gdal_from_source=False):
+    """Get the artifact cache key for a QGIS build.
+
+    The key covers the source commit, the build profile and its flags, the
+    OS release and the versions of the libraries QGIS links against. A
+    march of 'native' is resolved to the build host's CPU so artifacts
+    tuned for one CPU are not installed on hosts with another.
+
+    :param build_path: Path to the cmake build dir inside the checkout.
+    :type build_path: str
 
-    fabtools.require.deb.package('cmake-curses-gui')
-    fabtools.require.deb.package('grass-dev')
-    fabtools.require.deb.package('grass')
-    fabtools.require.deb.package('git')
-    fabtools.require.deb.package('python-gdal')
-    fabtools.require.deb.package('libfcgi-dev')
-    # Ensure we always have a clean build dir
-    if exists(build_path):
-        run('rm -rf %s' % build_path)
-    fabtools.require.directory(build_path)
-    with cd(build_path):
-        fabtools.require.directory(
+    :returns: Content key - see :func:`fabgis.artifacts.artifact_key`.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    with cd(os.path.dirname(build_path.rstrip('/'))), hide('output'):
+        commit = run('git rev-parse HEAD')
+    build_profile = QGIS_BUILD_PROFILES[profile]
+    if '%(march)s' in build_profile['cxx_flags']:
+        march = resolve_march(march)
+    return artifact_key(
+        commit,
+        build_profile['build_type'],
+        build_profile['cxx_flags'] % {'march': march, 'profile_dir': ''},
+        build_profile['linker_flags'] % {'march': march, 'profile_dir': ''},
+        build_profile.get('cmake_options', ''),
+        gdal_from_source,
+        get_build_facts(QGIS_ARTIFACT_PACKAGES))
+
+
+def prepare_qgis_build(
+        qgis_version, profile='debug', worktree=True, bundle=False):
+    """Install build dependencies and check out the sources for a version.
+
+    :param qgis_version: QGIS version to build. One of '1.8', '2.0', '2.2'
+        or 'master'.
+    :type qgis_version: str
+
+    :param profile: Build profile - see :func:`compile_qgis`.
+    :type profile: str
+
+    :param worktree: Whether the version's branch should be checked out in
+        its own worktree (see :func:`update_qgis_worktree`) rather than in
+        the single ~/dev/cpp/QGIS checkout. Hosts with git older than 2.5
+        always use the single checkout. Default True.
+    :type worktree: bool
+
+    :param bundle: Whether to update the sources from a git bundle made
+        on the control host instead of fetching from github on the remote
+        host - see :func:`fabgis.git.update_git_checkout`. Default False.
+    :type bundle: bool
+
+    :returns: A tuple of the path to the cmake build dir for the version
+        and profile and the source update result - see
+        :func:`fabgis.git.parse_git_sync`.
+    :rtype: tuple
+
+    .. versionadded:: 0.18.0
+    """
+    if qgis_version not in QGIS_VERSIONS:
+        raise Exception('Invalid QGIS version requested')
+    branch, build_dir = QGIS_VERSIONS[qgis_version]
+    if profile != 'debug':
+        build_dir = '%s-%s' % (build_dir, profile)
+
+    setup_env()
+    require_ccache()
+    add_ubuntugis_ppa()
+    if profile == 'server':
+        fabtools.require.deb.packages(QGIS_SERVER_PACKAGES)
+    else:
+        sudo('apt-get build-dep -y qgis')
+
+    fabtools.require.deb.package('libspatialindex-dev')
+    if qgis_version != '1.8' and profile != 'server':
+        #fabtools.require.deb.package('python-pyspatialite')
+        fabtools.require.deb.package('python-psycopg2')
+        fabtools.require.deb.package('python-qscintilla2')
+        fabtools.require.deb.package('libqscintilla2-dev')
+
+    if worktree and not git_worktrees_supported():
+        fastprint(red('git is older than 2.5, building from the single '
+                      'QGIS checkout instead of a worktree.\n'))
+        worktree = False
+    with build_phase('fetch'):
+        if worktree:
+            code_path, sync = update_qgis_worktree(branch, bundle=bundle)
+        else:
+            sync = clone_qgis(branch=branch, bundle=bundle)
+            code_path = '%s/cpp/QGIS' % env.fg.workspace
+    set_build_fact('commit', sync['new_head'])
+    return '%s/%s' % (code_path, build_dir), sync
+
+
+@task
+def install_qgis(qgis_version='master', gdal_from_source=False,
+                 profile='debug', generator='make', pch=False, unity=False,
+                 distributed=False, ram_build=False, worktree=True,
+                 incremental=False, artifacts=False, artifact_store=None,
+                 march='native', bundle=False):
+    """Install QGIS under /usr/local/qgis-<version>[-<profile>].
+
+    :param qgis_version: QGIS version to build. One of '1.8', '2.0', '2.2'
+        or 'master'. Default 'master'.
+    :type qgis_version: str
+
+    :param gdal_from_source: Whether gdal should be built from source.
+        Default False.
+    :type gdal_from_source: bool
+
+    :param profile: Build profile - see :func:`compile_qgis`. Each profile
+        has its own build dir and install prefix (see
+        :func:`get_qgis_prefix`) so profiles can be installed side by side.
+        Default 'debug'.
+    :type profile: str
+
+    :param generator: The cmake generator to use - 'make' or 'ninja'.
+        Default 'make'.
+    :type generator: str
+
+    :param pch: Whether precompiled headers should be used. Default False.
+    :type pch: bool
+
+    :param unity: Whether to do a cmake unity build. Default False.
+    :type unity: bool
+
+    :param distributed: Whether to use the distcc farm. Default False.
+    :type distributed: bool
+
+    :param ram_build: Whether to build in a tmpfs when RAM allows. Not
+        used for incremental builds. Default False.
+    :type ram_build: bool
+
+    :param worktree: Whether to build from a per branch worktree - see
+        :func:`prepare_qgis_build`. Default True.
+    :type worktree: bool
+
+    :param incremental: Whether to keep the existing build dir and only
+        rebuild what changed. Nothing is rebuilt at all when the sources
+        did not change since the last install with the same options.
+        Default False.
+    :type incremental: bool
+
+    :param artifacts: Whether to use the binary artifact cache. If an
+        artifact matching the commit, flags, OS release and dependency
+        versions exists it is unpacked instead of building, otherwise the
+        build result is stored for other hosts. Default False.
+    :type artifacts: bool
+
+    :param artifact_store: Where artifacts are kept - see
+        :mod:`fabgis.artifacts`. Defaults to the control host.
+    :type artifact_store: str
+
+    :param march: Architecture passed to -march for profiles that tune for
+        the CPU - see :func:`compile_qgis`. Default 'native'.
+    :type march: str
+
+    :param bundle: Whether to update the sources from a git bundle made
+        on the control host instead of fetching from github on the remote
+        host - see :func:`fabgis.git.update_git_checkout`. Default False.
+    :type bundle: bool
+
+    :returns: Wall clock seconds spent building (0 on an artifact hit or
+        when nothing had to be rebuilt).
+    :rtype: float
+
+    To run e.g.::
+
+        fab -H foo install_qgis:2.2,profile=release,generator=ninja
+
+    .. versionadded:: 0.18.0
+    """
+    with build_history('qgis', version=qgis_version):
+        build_path, sync = prepare_qgis_build(
+            qgis_version, profile, worktree, bundle)
+        build_prefix = get_qgis_prefix(qgis_version, profile)
+        install_stamp = '%s/%s' % (build_path, QGIS_INSTALL_STAMP)
+        install_key = artifact_key(
+            sync['new_head'], profile, generator, pch, unity,
+            gdal_from_source, build_prefix, march)
+        if incremental and not sync['changed']:
+            with settings(warn_only=True), hide('output', 'warnings'):
+                installed = run('test -d %s && cat %s' % (
+                    build_prefix, install_stamp))
+            if installed.succeeded and installed.strip() == install_key:
+                fastprint(green('QGIS %s is up to date in %s\n' % (
+                    qgis_version, build_prefix)))
+                set_build_fact('cached', True)
+                return 0
+        if artifacts:
+            key = qgis_artifact_key(
+                build_path, profile, march, gdal_from_source=gdal_from_source)
+            if fetch_artifact('qgis', key, build_prefix, artifact_store):
+                set_build_fact('cached', True)
+                return 0
+        elapsed = compile_qgis(
+            build_path,
             build_prefix,
-            use_sudo=True,
-            owner=env.fg.user)
-        os_version = run('cat /etc/issue.net')
-        os_version = float(os_version.split(' ')[1].split('.')[0])
+            gdal_from_source,
+            profile,
+            march=march,
+            generator=generator,
+            pch=pch,
+            unity=unity,
+            distributed=distributed,
+            ram_build=ram_build,
+            clean=not incremental)
+        with hide('output'):
+            run('mkdir -p %s && echo "%s" > %s' % (
+                build_path, install_key, install_stamp))
+        if artifacts:
+            store_artifact('qgis', key, build_prefix, artifact_store)
+        return elapsed
+
+
+@task
+def compare_qgis_generators(qgis_version='master', profile='debug'):
+    """Report the wall clock build time of make against ninja for QGIS.
 
-        if os_version >= 13:
-            extra = '-DPYTHON_LIBRARY=/usr/lib/x86_64-linux-gnu/libpython2.7.so'
+    QGIS is built twice from a clean build dir: once with Makefiles and
+    once with ninja, precompiled headers and a unity build. ccache is
+    disabled for both builds, otherwise the second build would mostly
+    measure cache hits.
+
+    :param qgis_version: QGIS version to build. Default 'master'.
+    :type qgis_version: str
+
+    :param profile: Build profile - see :func:`compile_qgis`.
+    :type profile: str
+
+    .. versionadded:: 0.18.0
+    """
+    with shell_env(CCACHE_DISABLE='1'):
+        make_time = install_qgis(qgis_version, profile=profile)
+        ninja_time = install_qgis(
+            qgis_version, profile=profile, generator='ninja', pch=True,
+            unity=True)
+    fastprint(green('make: %.0f seconds, ninja: %.0f seconds (%.1fx)\n' % (
+        make_time, ninja_time, make_time / ninja_time)))
+
+
+@task
+def install_qgis_versions(
+        versions='2.0;2.2;master',
+        profile='debug',
+        generator='make',
+        worktree=True,
+        swap=True):
+    """Build several QGIS versions at the same time on one host.
+
+    Each version is built from its own source tree (a worktree per branch by
+    default) and gets an equal, non overlapping share of the cores (pinned
+    with taskset) and of the available memory, which bounds its job count.
+    Dependencies and checkouts are prepared one version at a time, the
+    compiles then run concurrently. Build output goes to
+    ``<build dir>/fabgis-build.log`` and each build is recorded in the
+    build history (see :mod:`fabgis.history`).
+
+    :param versions: Semicolon separated list of QGIS versions to build.
+        Default '2.0;2.2;master'.
+    :type versions: str
+
+    :param profile: Build profile for all versions - see
+        :func:`compile_qgis`.
+    :type profile: str
+
+    :param generator: The cmake generator to use - 'make' or 'ninja'.
+    :type generator: str
+
+    :param worktree: Whether to build from per branch worktrees. Without
+        worktrees, or with git older than 2.5, only one version can be
+        built since the versions would share a checkout.
+    :type worktree: bool
+
+    :param swap: Whether to add temporary swap when the builds may not fit
+        in memory - see :func:`fabgis.system.ephemeral_swap`. Default True.
+    :type swap: bool
+
+    :returns: Dictionary of version to build wall time in seconds.
+    :rtype: dict
+
+    To run e.g.::
+
+        fab -H buildhost install_qgis_versions:"1.8;2.0;2.2;master"
+
+    .. versionadded:: 0.18.0
+    """
+    versions = [version for version in versions.split(';') if version]
+    if len(versions) > 1 and not (worktree and git_worktrees_supported()):
+        raise Exception(
+            'Building several QGIS versions needs worktrees (and git 2.5 or '
+            'newer), the versions would otherwise share one checkout')
+    builds = []
+    for version in versions:
+        build_path, _ = prepare_qgis_build(version, profile, worktree)
+        cmake = qgis_cmake_command(
+            build_path,
+            get_qgis_prefix(version, profile),
+            profile=profile,
+            generator=generator)
+        builds.append((version, build_path, cmake))
+
+    resources = get_host_resources()
+    cores_per_build = max(1, resources['cores'] / len(builds))
+    memory_per_build = resources['memory'] / len(builds)
+    jobs = max(1, min(
+        cores_per_build, memory_per_build / BUILD_JOB_MEMORY['qgis']))
+    _, load = get_build_jobs('qgis')
+    install_target = QGIS_BUILD_PROFILES[profile].get(
+        'install_target', 'install')
+    fastprint(green(
+        'Building %s versions with %s cores, %s MB and %s jobs each\n' % (
+            len(builds), cores_per_build, memory_per_build, jobs)))
+
+    scripts = []
+    for index, (version, build_path, cmake) in enumerate(builds):
+        first_core = (index * cores_per_build) % resources['cores']
+        cores = '%s-%s' % (first_core, first_core + cores_per_build - 1)
+        # Each phase is timed so the build can be recorded in the history
+        scripts.append(
+            '(cd %(build_path)s && t0=$(date +%%s) && '
+            '{ %(cmake)s && t1=$(date +%%s) && '
+            'taskset -c %(cores)s %(build)s && t2=$(date +%%s) && '
+            'taskset -c %(cores)s %(install)s; } '
+            '> fabgis-build.log 2>&1; status=$?; '
+            't3=$(date +%%s); t1=${t1:-$t3}; t2=${t2:-$t3}; '
+            'echo "FABGIS-BUILD %(version)s $status $((t1 - t0)) '
+            '$((t2 - t1)) $((t3 - t2))") &' % {
+                'build_path': build_path,
+                'cmake': cmake,
+                'cores': cores,
+                'build': cmake_build_command(
+                    generator, jobs, target='all', load=load),
+                'install': cmake_build_command(
+                    generator, jobs, target=install_target, load=load),
+                'version': version})
+
+    started = time.time()
+    with ccache_statistics('QGIS %s' % ', '.join(versions)), \
+            ephemeral_swap('qgis', jobs * len(builds), enabled=swap):
+        with settings(warn_only=True):
+            result = run(' '.join(scripts) + ' wait')
+
+    build_paths = dict([(build[0], build[1]) for build in builds])
+    timings = {}
+    for line in result.splitlines():
+        parts = line.split()
+        if len(parts) != 6 or parts[0] != 'FABGIS-BUILD':
+            continue
+        version, status = parts[1:3]
+        phases = dict(zip(
+            ['configure', 'compile', 'install'],
+            [int(seconds) for seconds in parts[3:]]))
+        seconds = sum(phases.values())
+        timings[version] = seconds
+        record_build(
+            'qgis',
+            started,
+            phases,
+            status='ok' if status == '0' else 'failed',
+            version=version,
+            profile=profile,
+            generator=generator,
+            jobs=jobs,
+            concurrent=len(builds))
+        if status == '0':
+            fastprint(green('QGIS %s built in %s seconds\n' % (
+                version, seconds)))
         else:
-            extra = ''
-
-        if gdal_from_source:
-            build_gdal()  # see that task for ecw and mrsid support
-            extra += '-DGDAL_CONFIG=/usr/local/bin/gdal-config '
-
-        cmake = (
-            'cmake .. '
-            '-DCMAKE_INSTALL_PREFIX=%s '
-            '-DCMAKE_CXX_COMPILER:FILEPATH=/usr/local/bin/g++ '
-            '-DQT_QMAKE_EXECUTABLE=/usr/bin/qmake-qt4 '
-            '-DWITH_MAPSERVER=ON '
-            '-DWITH_INTERNAL_SPATIALITE=ON '
-            '-DWITH_GRASS=OFF '
-            '-DCMAKE_BUILD_TYPE=Debug '
-            '%s'
-             % (build_prefix, extra))
-        run(cmake)
-        processor_count = get_processor_count()
-        run('time make -j %s install' % processor_count)
+            fastprint(red(
+                'QGIS %s failed after %s seconds, see %s/fabgis-build.log\n'
+                % (version, seconds, build_paths[version])))
+    return timings
 
 
 @task
-def install_qgis1_8(gdal_from_source=False):
+def install_qgis1_8(gdal_from_source=False, profile='debug'):
     """
     Install QGIS 1.8 under /usr/local/qgis-1.8.
 
@@ -121,109 +850,56 @@ def install_qgis1_8(gdal_from_source=False):
         Default False.
     :type gdal_from_source: bool
 
+    :param profile: Build profile - see :func:`compile_qgis`.
+    :type profile: str
 
     """
-    setup_env()
-    add_ubuntugis_ppa()
-    setup_ccache()
-    sudo('apt-get build-dep -y qgis')
-    fabtools.require.deb.package('libspatialindex-dev')
-    clone_qgis(branch='release-1_8')
-    workspace = '%s/cpp' % env.fg.workspace
-    code_path = '%s/QGIS' % workspace
-    build_path = '%s/build-qgis18-fabgis' % code_path
-    build_prefix = '/usr/local/qgis-1.8'
-    compile_qgis(build_path, build_prefix, gdal_from_source)
+    install_qgis('1.8', gdal_from_source, profile)
 
 
 @task
-def install_qgis2(gdal_from_source=False):
+def install_qgis2(gdal_from_source=False, profile='debug'):
     """Install QGIS 2 under /usr/local/qgis-2.0.
 
     :param gdal_from_source: Whether gdal should be built from source.
         Default False.
     :type gdal_from_source: bool
 
-    TODO: create one function from this and the 1.8 function above for DRY.
+    :param profile: Build profile - see :func:`compile_qgis`.
+    :type profile: str
 
     """
-    setup_env()
-    setup_ccache()
-    add_ubuntugis_ppa()
-    sudo('apt-get build-dep -y qgis')
-
-    #fabtools.require.deb.package('python-pyspatialite')
-    fabtools.require.deb.package('python-psycopg2')
-    fabtools.require.deb.package('python-qscintilla2')
-    fabtools.require.deb.package('libqscintilla2-dev')
-    fabtools.require.deb.package('libspatialindex-dev')
-
-    clone_qgis(branch='release-2_0')
-    workspace = '%s/cpp' % env.fg.workspace
-    code_path = '%s/QGIS' % workspace
-    build_path = '%s/build-qgis2-fabgis' % code_path
-    build_prefix = '/usr/local/qgis-2.0'
-    compile_qgis(build_path, build_prefix, gdal_from_source)
+    install_qgis('2.0', gdal_from_source, profile)
 
 
 @task
-def install_qgis2_2(gdal_from_source=False):
+def install_qgis2_2(gdal_from_source=False, profile='debug'):
     """Install QGIS 2 under /usr/local/qgis-2.2.
 
     :param gdal_from_source: Whether gdal should be built from source.
         Default False.
     :type gdal_from_source: bool
 
-    TODO: create one function from this and the 1.8 function above for DRY.
+    :param profile: Build profile - see :func:`compile_qgis`.
+    :type profile: str
 
     """
-    setup_env()
-    setup_ccache()
-    add_ubuntugis_ppa()
-    sudo('apt-get build-dep -y qgis')
-
-    #fabtools.require.deb.package('python-pyspatialite')
-    fabtools.require.deb.package('python-psycopg2')
-    fabtools.require.deb.package('python-qscintilla2')
-    fabtools.require.deb.package('libqscintilla2-dev')
-    fabtools.require.deb.package('libspatialindex-dev')
-
-    clone_qgis(branch='release-2_2')
-    workspace = '%s/cpp' % env.fg.workspace
-    code_path = '%s/QGIS' % workspace
-    build_path = '%s/build-qgis2_2-fabgis' % code_path
-    build_prefix = '/usr/local/qgis-2.2'
-    compile_qgis(build_path, build_prefix, gdal_from_source)
+    install_qgis('2.2', gdal_from_source, profile)
 
 
 @task
-def install_qgis_master(gdal_from_source=False):
+def install_qgis_master(gdal_from_source=False, profile='debug'):
     """Install QGIS master under /usr/local/qgis-master.
 
     :param gdal_from_source: Whether gdal should be built from source.
         Default False.
     :type gdal_from_source: bool
 
-    TODO: create one function from this and the 1.8 function above for DRY.
+    :param profile: Build profile - see :func:`compile_qgis`.
+    :type profile: str
 
     """
-    setup_env()
-    setup_ccache()
-    add_ubuntugis_ppa()
-    sudo('apt-get build-dep -y qgis')
-
-    #fabtools.require.deb.package('python-pyspatialite')
-    fabtools.require.deb.package('python-psycopg2')
-    fabtools.require.deb.package('python-qscintilla2')
-    fabtools.require.deb.package('libqscintilla2-dev')
-    fabtools.require.deb.package('libspatialindex-dev')
-
-    clone_qgis(branch='master')
-    workspace = '%s/cpp' % env.fg.workspace
-    code_path = '%s/QGIS' % workspace
-    build_path = '%s/build-master-fabgis' % code_path
-    build_prefix = '/usr/local/qgis-master'
-    compile_qgis(build_path, build_prefix, gdal_from_source)
+    install_qgis('master', gdal_from_source, profile)
 
 
 @task
@@ -242,10 +918,13 @@ def setup_qgis_server(
         qgis_version='2.0',
         server_admin='none@none.com',
         template_dir=None,
+        profile='server',
+        build=True,
         **kwargs):
     """Set up QGIS Server for QGIS.
 
-    We assume your QGIS was built using fabgis into /usr/local/qgis-<version>.
+    We assume your QGIS was built using fabgis into
+    /usr/local/qgis-<version>[-<profile>] (see :func:`get_qgis_prefix`).
 
     Place your projects in subdirectories of web root for them to be published.
 
@@ -257,7 +936,7 @@ def setup_qgis_server(
     :type web_root: str
 
     :param qgis_version: The version you wish to server maps with. Currently
-        supported values are '1.8', '2.0' and 'master'.
+        supported values are '1.8', '2.0', '2.2' and 'master'.
     :type qgis_version: str
 
     :param server_admin: Email address for the server admin. Defaults to
@@ -271,6 +950,17 @@ def setup_qgis_server(
         relative path to the fabfile you are running.
     :type template_dir: str
 
+    :param profile: Build profile the served binary is built with - see
+        :func:`compile_qgis`. Defaults to 'server', an optimised build of
+        just the map server; a debug map server is several times slower per
+        GetMap request.
+    :type profile: str
+
+    :param build: Whether QGIS should be (re)built for the profile first.
+        Pass False to deploy a binary that is already installed, e.g. one
+        made by :func:`build_qgis_server_pgo`. Default True.
+    :type build: bool
+
     :param kwargs: Any extra keyword arguments that should be appended to the
         token list that will be used when rendering the apache config template.
         Use this to pass in sensitive data such as passwords.
@@ -278,17 +968,14 @@ def setup_qgis_server(
 
     :returns: Path to the apache conf file.
     :rtype: str
+
+    .. versionchanged:: 0.18.0
+        profile and build parameters added, the server now defaults to a
+        server only release build.
     """
     setup_env()
-    if qgis_version == '1.8':
-        install_qgis1_8()
-    elif qgis_version == '2.0':
-        install_qgis2()
-        pass
-    elif qgis_version == 'master':
-        install_qgis_master()
-    else:
-        raise Exception('Invalid QGIS version requested')
+    if build:
+        install_qgis(qgis_version, profile=profile)
     # Clone and replace tokens in apache conf
     if template_dir is None:
         template_dir = os.path.join(
@@ -298,7 +985,7 @@ def setup_qgis_server(
     template_path = os.path.join(template_dir, filename)
     fastprint(green('Using %s for template\n' % template_path))
     cgi_path = os.path.join(web_root, 'qgis-%s' % qgis_version)
-    qgis_prefix = '/usr/local/qgis-%s' % qgis_version
+    qgis_prefix = get_qgis_prefix(qgis_version, profile)
 
     require.directory(cgi_path)
     with cd(cgi_path):
@@ -339,3 +1026,330 @@ def setup_qgis_server(
     fastprint(green('%s\n' % cgi_path))
 
     return destination
+
+
+def _mapserv_environment(qgis_prefix):
+    """Shell snippet exporting what qgis_mapserv needs to run as a CGI.
+
+    The fcgi binary falls back to plain CGI mode when it is not started by a
+    FastCGI process manager so we can drive it directly with QUERY_STRING
+    without apache or any network access.
+    """
+    return (
+        'export QGIS_PREFIX_PATH=%(prefix)s '
+        'LD_LIBRARY_PATH=%(prefix)s/lib REQUEST_METHOD=GET; ' % {
+            'prefix': qgis_prefix})
+
+
+def _time_wms_request(qgis_prefix, map_path, query, iterations):
+    """Time repeated CGI invocations of qgis_mapserv against a project.
+
+    :returns: Wall time in milliseconds of each request.
+    :rtype: list
+    """
+    query_string = 'MAP=%s&%s' % (map_path, query)
+    command = (
+        '%(environment)s'
+        'export QUERY_STRING=%(query)s; '
+        'for i in $(seq %(iterations)s); do '
+        'start=$(date +%%s%%N); '
+        '%(prefix)s/bin/qgis_mapserv.fcgi > /dev/null 2>&1; '
+        'end=$(date +%%s%%N); '
+        'echo $(( (end - start) / 1000000 )); '
+        'done' % {
+            'environment': _mapserv_environment(qgis_prefix),
+            'prefix': qgis_prefix,
+            'query': quote(query_string),
+            'iterations': iterations})
+    with hide('output'):
+        result = run(command)
+    return [int(line) for line in result.splitlines() if line.strip()]
+
+
+@task
+def benchmark_qgis_server(
+        map_path,
+        layers,
+        bbox,
+        qgis_version='2.0',
+        profiles='debug,release,relwithdebinfo,lto',
+        crs='EPSG:4326',
+        width=512,
+        height=512,
+        iterations=20):
+    """Compare GetMap render latency of QGIS server across build profiles.
+
+    Each profile must already be installed (e.g. with
+    ``install_qgis:2.0,profile=release``). Profiles that are not installed
+    are skipped.
+
+    :param map_path: Path on the remote host to the QGIS project to render.
+    :type map_path: str
+
+    :param layers: Comma separated list of layers to render.
+    :type layers: str
+
+    :param bbox: Extent to render as minx,miny,maxx,maxy in the units of crs.
+        Use ``;`` as the separator when passing it on the fab command line.
+    :type bbox: str
+
+    :param qgis_version: QGIS version to benchmark. Default '2.0'.
+    :type qgis_version: str
+
+    :param profiles: Comma separated (or ``;`` separated when passing
+        on the fab command line) list of profiles to compare.
+    :type profiles: str
+
+    :param crs: CRS of the request. Default 'EPSG:4326'.
+    :type crs: str
+
+    :param width: Image width in pixels. Default 512.
+    :type width: int
+
+    :param height: Image height in pixels. Default 512.
+    :type height: int
+
+    :param iterations: Number of GetMap requests per profile. Default 20.
+    :type iterations: int
+
+    :returns: Dictionary of profile to median latency in milliseconds.
+    :rtype: dict
+
+    :raises: Exception if iterations is less than 1.
+
+    To run e.g.::
+
+        fab -H foo benchmark_qgis_server:/home/web/world.qgs,roads,"0;40;20;60"
+
+    .. versionadded:: 0.18.0
+    """
+    iterations = int(iterations)
+    if iterations < 1:
+        raise Exception('iterations must be at least 1, got %s' % iterations)
+    setup_env()
+    query = (
+        'SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&FORMAT=image/png'
+        '&LAYERS=%s&STYLES=&CRS=%s&BBOX=%s&WIDTH=%s&HEIGHT=%s' % (
+            layers, crs, bbox.replace(';', ','), width, height))
+    results = {}
+    for profile in profiles.replace(';', ',').split(','):
+        qgis_prefix = get_qgis_prefix(qgis_version, profile)
+        if not exists(os.path.join(qgis_prefix, 'bin', 'qgis_mapserv.fcgi')):
+            fastprint(red(
+                'Profile %s is not installed, skipping.\n' % profile))
+            continue
+        # Warm up the file cache so the first profile is not penalised
+        _time_wms_request(qgis_prefix, map_path, query, 1)
+        timings = sorted(
+            _time_wms_request(qgis_prefix, map_path, query, iterations))
+        median = timings[len(timings) / 2]
+        results[profile] = median
+        fastprint(green(
+            '%s: median %s ms, min %s ms, max %s ms\n' % (
+                profile, median, timings[0], timings[-1])))
+
+    if 'debug' in results:
+        for profile, median in results.iteritems():
+            if profile != 'debug' and median:
+                fastprint(green('%s is %.1fx faster than debug\n' % (
+                    profile, float(results['debug']) / median)))
+    return results
+
+
+def _replay_wms_workload(qgis_prefix, workload_path):
+    """Replay a file of WMS query strings against qgis_mapserv.
+
+    A single qgis_mapserv.fcgi process is started with cgi-fcgi on a local
+    socket and serves the whole workload, the way it runs under mod_fcgid,
+    so the project is only loaded once. The process is asked to shut down
+    with SIGUSR1 afterwards, which lets it exit normally and write out any
+    profile data.
+
+    :param qgis_prefix: Prefix of the QGIS install whose server should be
+        driven.
+    :type qgis_prefix: str
+
+    :param workload_path: Path on the remote host to a file with one query
+        string per line.
+    :type workload_path: str
+
+    :returns: Total wall time in milliseconds for the whole workload.
+    :rtype: int
+
+    :raises: Exception if any of the requests failed or returned a
+        ServiceException.
+    """
+    command = (
+        '%(environment)s'
+        'rm -f %(socket)s; '
+        'cgi-fcgi -start -connect %(socket)s '
+        '%(prefix)s/bin/qgis_mapserv.fcgi 1 || exit 1; '
+        'failed=0; '
+        'start=$(date +%%s%%N); '
+        'while IFS= read -r query; do '
+        'QUERY_STRING="$query" cgi-fcgi -bind -connect %(socket)s '
+        '> %(response)s 2> /dev/null && '
+        'head -c 4096 %(response)s | grep -qi "^content-type" && '
+        '! grep -q ServiceExceptionReport %(response)s || '
+        'failed=$((failed + 1)); '
+        'done < %(workload)s; '
+        'end=$(date +%%s%%N); '
+        # Anchored so the pattern does not match this shell's command line
+        'pkill -USR1 -f "^%(prefix)s/bin/qgis_mapserv"; '
+        'for i in $(seq 60); do '
+        'pgrep -f "^%(prefix)s/bin/qgis_mapserv" > /dev/null || break; '
+        'sleep 1; '
+        'done; '
+        'rm -f %(socket)s %(response)s; '
+        'echo $(( (end - start) / 1000000 )) $failed' % {
+            'environment': _mapserv_environment(qgis_prefix),
+            'prefix': qgis_prefix,
+            'socket': '/tmp/fabgis-mapserv.sock',
+            'response': '/tmp/fabgis-mapserv.response',
+            'workload': workload_path})
+    with hide('output'):
+        result = run(command)
+    elapsed, failed = result.strip().splitlines()[-1].split()
+    if int(failed):
+        raise Exception(
+            '%s requests from %s failed against %s' % (
+                failed, workload_path, qgis_prefix))
+    return int(elapsed)
+
+
+def _read_wms_workload(workload_file, map_path):
+    """Extract WMS query strings from a recorded request log.
+
+    Lines may be bare query strings or request urls / apache access log
+    lines containing one. Only GetMap and GetFeatureInfo requests are kept
+    and the MAP parameter is replaced by map_path.
+
+    :returns: List of query strings.
+    :rtype: list
+    """
+    queries = []
+    for line in open(workload_file):
+        line = line.strip()
+        if '?' in line:
+            line = line.split('?', 1)[1]
+        # Access log lines have the protocol and status after the url
+        line = line.split(' ', 1)[0]
+        lowered = line.lower()
+        if ('request=getmap' not in lowered and
+                'request=getfeatureinfo' not in lowered):
+            continue
+        parameters = [
+            parameter for parameter in line.split('&')
+            if not parameter.lower().startswith('map=')]
+        queries.append('&'.join(['MAP=%s' % map_path] + parameters))
+    return queries
+
+
+@task
+def build_qgis_server_pgo(
+        site_name,
+        map_path,
+        workload_file,
+        web_root='/home/web/qgis-server',
+        qgis_version='2.0',
+        march='native',
+        iterations=3,
+        **kwargs):
+    """Build a profile guided optimised QGIS server and deploy it.
+
+    QGIS is first built with the 'pgo-generate' profile, then a recorded WMS
+    workload is replayed against the instrumented qgis_mapserv.fcgi (one
+    persistent FastCGI process driven with cgi-fcgi over a local socket, no
+    web server needed) and finally QGIS is rebuilt with the 'pgo' profile
+    using the collected profiles and deployed with
+    :func:`setup_qgis_server`. The build stops if any replayed request
+    fails or no profile data was written.
+
+    :param site_name: Name of the site e.g. qgis.linfiniti.com - see
+        :func:`setup_qgis_server`.
+    :type site_name: str
+
+    :param map_path: Path to the QGIS project to replay the workload
+        against, relative to web_root.
+    :type map_path: str
+
+    :param workload_file: Local file containing the recorded requests, one
+        per line. Query strings, request urls and apache access log lines
+        are all accepted; only GetMap and GetFeatureInfo requests are used.
+    :type workload_file: str
+
+    :param web_root: Directory where the content lives.
+    :type web_root: str
+
+    :param qgis_version: QGIS version to build. Default '2.0'.
+    :type qgis_version: str
+
+    :param march: Architecture passed to -march. Default 'native'.
+    :type march: str
+
+    :param iterations: Number of times the workload is replayed against the
+        instrumented build. Default 3.
+    :type iterations: int
+
+    :param kwargs: Any extra keyword arguments are passed on to
+        :func:`setup_qgis_server`.
+    :type kwargs: dict
+
+    :returns: Path to the apache conf file.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    setup_env()
+    map_path = os.path.join(web_root, map_path)
+    queries = _read_wms_workload(workload_file, map_path)
+    if not queries:
+        raise Exception('No GetMap/GetFeatureInfo requests in workload')
+    fastprint(green('Replaying %s recorded requests\n' % len(queries)))
+    # cgi-fcgi drives the FastCGI server without apache
+    fabtools.require.deb.package('libfcgi-bin')
+
+    # Build the instrumented binary, then the optimised one, in the same
+    # build dir so gcc can match the profiles up with the object files.
+    build_path, _ = prepare_qgis_build(qgis_version, 'pgo')
+    profile_dir = '%s-pgo-data' % build_path.rstrip('/')
+    instrumented_prefix = get_qgis_prefix(qgis_version, 'pgo-generate')
+    run('rm -rf %s' % profile_dir)
+    compile_qgis(
+        build_path, instrumented_prefix, profile='pgo-generate', march=march)
+
+    workload_path = '/tmp/fabgis-wms-workload.txt'
+    put(StringIO('\n'.join(queries) + '\n'), workload_path)
+    for _ in range(int(iterations)):
+        _replay_wms_workload(instrumented_prefix, workload_path)
+    with hide('output'):
+        profiles = run(
+            'find %s -name "*.gcda" 2> /dev/null | wc -l' % profile_dir)
+    if not int(profiles.strip()):
+        raise Exception(
+            'The workload wrote no profile data to %s' % profile_dir)
+    fastprint(green('Collected %s profile files\n' % profiles.strip()))
+
+    compile_qgis(
+        build_path,
+        get_qgis_prefix(qgis_version, 'pgo'),
+        profile='pgo',
+        march=march)
+    sudo('rm -rf %s' % instrumented_prefix)
+
+    release_prefix = get_qgis_prefix(qgis_version, 'release')
+    if exists(os.path.join(release_prefix, 'bin', 'qgis_mapserv.fcgi')):
+        release_time = _replay_wms_workload(release_prefix, workload_path)
+        pgo_time = _replay_wms_workload(
+            get_qgis_prefix(qgis_version, 'pgo'), workload_path)
+        fastprint(green('Workload: release %s ms, pgo %s ms\n' % (
+            release_time, pgo_time)))
+    run('rm %s' % workload_path)
+
+    return setup_qgis_server(
+        site_name,
+        web_root=web_root,
+        qgis_version=qgis_version,
+        profile='pgo',
+        build=False,
+        **kwargs)
@@ -5,14 +5,17 @@ System related tasks.
 
 Tools for setting up and hardening a system."""
 
+from contextlib import contextmanager
 from getpass import getpass
+from StringIO import StringIO
 
-from fabric.api import cd, fastprint, prompt
+from fabric.api import cd, fastprint, prompt, hide, settings, put
 from fabric.contrib.files import contains, exists, append, sed
-from fabric.colors import red
+from fabric.colors import red, blue
 from fabric.api import env, task, sudo, local, reboot
 from fabric.operations import run
 import fabtools
+from .common import setup_env
 from .utilities import append_if_not_present
 
 
@@ -24,14 +27,165 @@ def setup_qt4_developer_tools():
     fabtools.require.deb.package('qt4-linguist-tools')
 
 
+CCACHE_PROFILE = '/etc/profile.d/fabgis-ccache.sh'
+
+
 @task
-def setup_ccache():
-    """Setup ccache."""
+def setup_ccache(
+        max_size='20G',
+        compress=True,
+        cache_dir='/var/cache/ccache',
+        base_dir=None):
+    """Setup ccache with a shared, sized and compressed cache.
+
+    The settings are written as environment variables to
+    /etc/profile.d/fabgis-ccache.sh (which fabric's login shell picks up) so
+    that every ccache version honours them. With base_dir set to the
+    workspace, absolute paths below it are rewritten as relative ones so
+    the QGIS build dirs for different branches, and the GDAL, proj4 and
+    hdf5 builds, can all hit each other's cache entries.
+
+    :param max_size: Maximum size of the cache e.g. '20G'.
+    :type max_size: str
+
+    :param compress: Whether cache entries should be compressed.
+    :type compress: bool
+
+    :param cache_dir: Directory holding the cache, shared by all builds on
+        the host. Default /var/cache/ccache.
+    :type cache_dir: str
+
+    :param base_dir: Paths below this dir are hashed relative to the build
+        dir. Defaults to the fabgis workspace (~/dev).
+    :type base_dir: str
+
+    .. versionchanged:: 0.18.0
+        max_size, compress, cache_dir and base_dir parameters added.
+    """
+    setup_env()
+    if base_dir is None:
+        base_dir = env.fg.workspace
     fabtools.require.deb.package('ccache')
     sudo('ln -fs /usr/bin/ccache /usr/local/bin/gcc')
     sudo('ln -fs /usr/bin/ccache /usr/local/bin/g++')
     sudo('ln -fs /usr/bin/ccache /usr/local/bin/cc')
 
+    fabtools.require.directory(cache_dir, use_sudo=True, owner=env.fg.user)
+    sudo('chmod 2775 %s' % cache_dir)
+    settings_file = (
+        'export CCACHE_DIR=%(cache_dir)s\n'
+        'export CCACHE_BASEDIR=%(base_dir)s\n'
+        # Build dirs differ per branch so the cwd must not be hashed
+        'export CCACHE_NOHASHDIR=1\n'
+        'export CCACHE_SLOPPINESS=pch_defines,time_macros\n'
+        'export CCACHE_UMASK=002\n' % {
+            'cache_dir': cache_dir,
+            'base_dir': base_dir})
+    if compress:
+        settings_file += 'export CCACHE_COMPRESS=1\n'
+    put(StringIO(settings_file), CCACHE_PROFILE, use_sudo=True, mode=0o644)
+    run('CCACHE_DIR=%s ccache -M %s' % (cache_dir, max_size))
+
+
+def require_ccache():
+    """Make sure ccache is set up, without changing an existing setup.
+
+    Builds call this rather than :func:`setup_ccache` so the cache settings
+    an operator chose with setup_ccache are kept. The defaults are only
+    written on hosts where ccache was never set up.
+
+    .. versionadded:: 0.18.0
+    """
+    # setup_ccache writes the profile last
+    if exists(CCACHE_PROFILE):
+        return
+    setup_ccache()
+
+
+def get_ccache_stats():
+    """Get the ccache hit and miss counters on the remote host.
+
+    :returns: Dictionary of counters. It always contains 'hits' and
+        'misses'; with ccache 4 all the raw ``--print-stats`` counters are
+        included too, along with 'remote_hits' and 'remote_misses' for the
+        fleet shared cache (see :mod:`fabgis.ccache`).
+    :rtype: dict
+
+    .. versionadded:: 0.18.0
+    """
+    with settings(warn_only=True), hide('output', 'warnings'):
+        output = run('ccache --print-stats 2> /dev/null || ccache -s')
+    stats = {}
+    if '\t' in output:
+        # ccache 4 machine readable counters
+        for line in output.splitlines():
+            if '\t' in line:
+                key, value = line.split('\t', 1)
+                if value.strip().isdigit():
+                    stats[key.strip()] = int(value)
+        stats['hits'] = (
+            stats.get('direct_cache_hit', 0) +
+            stats.get('preprocessed_cache_hit', 0))
+        stats['misses'] = stats.get('cache_miss', 0)
+        # Called secondary storage before ccache 4.8
+        stats['remote_hits'] = (
+            stats.get('remote_storage_hit', 0) +
+            stats.get('secondary_storage_hit', 0))
+        stats['remote_misses'] = (
+            stats.get('remote_storage_miss', 0) +
+            stats.get('secondary_storage_miss', 0))
+    else:
+        # ccache 3 human readable summary e.g. 'cache hit (direct)   123'
+        stats['hits'] = 0
+        stats['misses'] = 0
+        for line in output.splitlines():
+            value = line.split()[-1] if line.split() else ''
+            if not value.isdigit():
+                continue
+            if line.startswith('cache hit'):
+                stats['hits'] += int(value)
+            elif line.startswith('cache miss'):
+                stats['misses'] += int(value)
+    return stats
+
+
+@contextmanager
+def ccache_statistics(label):
+    """Context manager printing ccache statistics before and after a build.
+
+    :param label: Name of the build to print with the statistics.
+    :type label: str
+
+    e.g.::
+
+        with ccache_statistics('GDAL'):
+            run('make')
+
+    .. versionadded:: 0.18.0
+    """
+    before = get_ccache_stats()
+    fastprint(blue('ccache before %s build: %s hits, %s misses\n' % (
+        label, before['hits'], before['misses'])))
+    yield
+    after = get_ccache_stats()
+    hits = after['hits'] - before['hits']
+    misses = after['misses'] - before['misses']
+    if hits + misses:
+        rate = 100.0 * hits / (hits + misses)
+    else:
+        rate = 0.0
+    fastprint(blue(
+        'ccache after %s build: %s hits, %s misses (%.1f%% hit rate)\n' % (
+            label, hits, misses, rate)))
+    remote_hits = after.get('remote_hits', 0) - before.get('remote_hits', 0)
+    remote_misses = (
+        after.get('remote_misses', 0) - before.get('remote_misses', 0))
+    if remote_hits + remote_misses:
+        fastprint(blue(
+            'ccache remote storage: %s hits, %s misses (%.1f%% hit rate)\n'
+            % (remote_hits, remote_misses,
+               100.0 * remote_hits / (remote_hits + remote_misses))))
+
 
 @task
 def install_modxsend():
@@ -322,4 +476,336 @@ def masquerade():
 
 
 def get_processor_count():
+    """Get the raw number of processors on the remote host.
+
+    .. seealso:: :func:`get_build_jobs` which should be used to decide how
+        many parallel build jobs to run.
+    """
     return run('cat /proc/cpuinfo | grep ^processor | wc -l')
+
+
+# Rough peak resident memory in MB of a single compile job for each of the
+# projects fabgis builds. QGIS is dominated by the sip generated python
+# bindings which can each need well over a GB.
+BUILD_JOB_MEMORY = {
+    'qgis': 1500,
+    'gdal': 500,
+    'ecw': 300,
+    'proj4': 200,
+    'hdf5': 300,
+    'postgis': 300,
+    'osm2pgsql': 700,
+}
+DEFAULT_BUILD_JOB_MEMORY = 500
+
+
+def get_host_resources():
+    """Get the cores, memory and load of the remote host.
+
+    They are all read in a single remote call.
+
+    :returns: A dictionary with 'cores', 'memory' (available MB),
+        'total_memory' (MB) and 'load' (one minute load average).
+    :rtype: dict
+
+    .. versionadded:: 0.18.0
+    """
+    with hide('output'):
+        facts = run(
+            'nproc; cat /proc/loadavg; '
+            'grep -E "^(MemTotal|MemAvailable|MemFree|Buffers|Cached):" '
+            '/proc/meminfo')
+    lines = facts.splitlines()
+    memory = {}
+    for line in lines[2:]:
+        key, value = line.split(':')
+        memory[key.strip()] = int(value.split()[0]) / 1024
+    if 'MemAvailable' in memory:
+        available = memory['MemAvailable']
+    else:
+        # Older kernels do not estimate available memory for us
+        available = (
+            memory.get('MemFree', 0) + memory.get('Buffers', 0) +
+            memory.get('Cached', 0))
+    return {
+        'cores': int(lines[0].strip()),
+        'load': float(lines[1].split()[0]),
+        'memory': available,
+        'total_memory': memory['MemTotal']}
+
+
+def get_build_jobs(project=None, reserve_memory=512):
+    """Work out how many parallel jobs a build should run on the remote host.
+
+    The job count is the smaller of the idle cores (cores less the current
+    load average) and the number of jobs that fit in available memory using
+    the per job estimate in BUILD_JOB_MEMORY, and is never less than one.
+
+    :param project: Name of the project being built e.g. 'qgis'. Used to
+        look up the memory needed per job. If None a generic estimate is
+        used.
+    :type project: str
+
+    :param reserve_memory: MB of available memory to leave alone for the
+        rest of the system. Default 512.
+    :type reserve_memory: int
+
+    :returns: A tuple of the job count and the load average limit which
+        should be passed to make's ``-l`` option.
+    :rtype: tuple
+
+    .. versionadded:: 0.18.0
+    """
+    resources = get_host_resources()
+    cores = resources['cores']
+    job_memory = BUILD_JOB_MEMORY.get(project, DEFAULT_BUILD_JOB_MEMORY)
+    cpu_jobs = cores - int(resources['load'])
+    memory_jobs = (resources['memory'] - reserve_memory) / job_memory
+    jobs = max(1, min(cpu_jobs, memory_jobs))
+    fastprint(
+        'Build jobs for %s: %s (%s cores, load %s, %s MB available)\n' % (
+            project, jobs, cores, resources['load'], resources['memory']))
+    return jobs, cores
+
+
+def get_make_flags(project=None):
+    """Get make's job and load limiting flags for a build.
+
+    :param project: Name of the project being built - see
+        :func:`get_build_jobs`.
+    :type project: str
+
+    :returns: Flags such as ``-j 6 -l 8``.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    jobs, load = get_build_jobs(project)
+    return '-j %s -l %s' % (jobs, load)
+
+
+def resolve_march(march='native'):
+    """Get the CPU a -march value really targets on the remote host.
+
+    :param march: Value passed to -march. 'native' is resolved to the CPU
+        gcc detects e.g. 'skylake', anything else is returned unchanged.
+    :type march: str
+
+    :returns: The resolved -march value.
+    :rtype: str
+
+    .. versionadded:: 0.18.0
+    """
+    if march != 'native':
+        return march
+    with hide('output'):
+        target = run(
+            'gcc -march=native -Q --help=target | grep -- "-march=" | '
+            'head -n 1')
+    return target.split()[-1]
+
+
+# Rough peak size in MB of the build tree (sources plus objects) of each
+# project, used to size RAM backed build dirs.
+BUILD_TREE_SIZE = {
+    'qgis': 8000,
+    'gdal': 2500,
+    'proj4': 200,
+    'hdf5': 600,
+}
+DEFAULT_BUILD_TREE_SIZE = 2000
+
+
+@contextmanager
+def tmpfs_build_dir(
+        path,
+        project=None,
+        copy_from=None,
+        enabled=True,
+        size=None,
+        reserve_memory=4096):
+    """Context manager running a build in a RAM backed (tmpfs) directory.
+
+    A tmpfs is mounted at path for the duration of the block and unmounted
+    afterwards, so anything not installed elsewhere is thrown away. If the
+    host does not have enough free memory for the build tree plus
+    reserve_memory (left for the compilers themselves) the build falls
+    back to disk.
+
+    :param path: Where to mount the tmpfs.
+    :type path: str
+
+    :param project: Name of the project being built, used to look up the
+        size of its build tree in BUILD_TREE_SIZE.
+    :type project: str
+
+    :param copy_from: Optional source tree to copy into the tmpfs, for
+        in-source builds. When falling back to disk this dir is yielded
+        instead of path.
+    :type copy_from: str
+
+    :param enabled: Whether to try a RAM build at all. Default True.
+    :type enabled: bool
+
+    :param size: Size of the tmpfs in MB. Overrides the project estimate.
+    :type size: int
+
+    :param reserve_memory: MB of memory that must stay free for the build
+        jobs. Default 4096.
+    :type reserve_memory: int
+
+    :returns: The directory the build should be run in.
+    :rtype: str
+
+    e.g.::
+
+        with tmpfs_build_dir(build_path, 'qgis') as build_dir:
+            with cd(build_dir):
+                run('cmake .. && make install')
+
+    .. versionadded:: 0.18.0
+    """
+    disk_dir = copy_from or path
+    if not enabled:
+        yield disk_dir
+        return
+    if size is None:
+        size = BUILD_TREE_SIZE.get(project, DEFAULT_BUILD_TREE_SIZE)
+    available = get_host_resources()['memory']
+    if available < size + reserve_memory:
+        fastprint(red(
+            'Only %s MB free, %s MB needed for a RAM build of %s - building '
+            'on disk.\n' % (available, size + reserve_memory, project)))
+        yield disk_dir
+        return
+
+    fastprint(blue('Building %s in a %s MB tmpfs at %s\n' % (
+        project, size, path)))
+    with hide('output'):
+        uid = run('id -u')
+    sudo('mkdir -p %s' % path)
+    sudo('mount -t tmpfs -o size=%sm,uid=%s,mode=0755 tmpfs %s' % (
+        size, uid, path))
+    try:
+        if copy_from is not None:
+            fabtools.require.deb.package('rsync')
+            run('rsync -a %s/ %s/' % (copy_from.rstrip('/'), path))
+        yield path
+    finally:
+        with cd('/'):
+            sudo('umount %s' % path)
+
+
+# Records the peak KB used on swap device $1 in file $2 every 5 seconds
+SWAP_SAMPLER = '''#!/bin/sh
+peak=0
+while true; do
+    used=$(awk -v device="$1" '$1 == device {print $4}' /proc/swaps)
+    if [ "${used:-0}" -gt "$peak" ]; then
+        peak=$used
+        echo $peak > "$2"
+    fi
+    sleep 5
+done
+'''
+
+
+@contextmanager
+def ephemeral_swap(
+        project=None,
+        jobs=1,
+        method='zram',
+        reserve_memory=512,
+        enabled=True):
+    """Context manager adding temporary swap when a build may not fit in RAM.
+
+    The build's peak memory is estimated as jobs times its per job estimate
+    in BUILD_JOB_MEMORY plus reserve_memory. If that is more than the
+    available memory, swap the size of the gap is added for the duration
+    of the block - compressed RAM (zram) or a swapfile - and removed again
+    afterwards. The peak amount of that swap used is reported.
+
+    :param project: Name of the project being built e.g. 'qgis'.
+    :type project: str
+
+    :param jobs: Number of parallel compile jobs the build runs. Default 1.
+    :type jobs: int
+
+    :param method: 'zram' for a compressed RAM swap device, falling back to
+        a swapfile if the kernel has no zram module, or 'swapfile'.
+        Default 'zram'.
+    :type method: str
+
+    :param reserve_memory: MB the rest of the system needs. Default 512.
+    :type reserve_memory: int
+
+    :param enabled: Whether to add swap at all. Default True.
+    :type enabled: bool
+
+    e.g.::
+
+        with ephemeral_swap('qgis', jobs):
+            run('make -j %s' % jobs)
+
+    .. versionadded:: 0.18.0
+    """
+    if not enabled:
+        yield
+        return
+    job_memory = BUILD_JOB_MEMORY.get(project, DEFAULT_BUILD_JOB_MEMORY)
+    needed = int(jobs) * job_memory + reserve_memory
+    available = get_host_resources()['memory']
+    gap = needed - available
+    if gap <= 0:
+        yield
+        return
+
+    device = None
+    if method == 'zram':
+        with settings(warn_only=True), hide('output', 'warnings'):
+            result = sudo('modprobe zram && zramctl --find --size %sM' % gap)
+        if result.succeeded and result.strip().startswith('/dev/'):
+            device = result.strip()
+            sudo('mkswap %s' % device)
+            # Prefer the compressed RAM over any disk swap
+            sudo('swapon --priority 100 %s' % device)
+        else:
+            fastprint(red('zram is not available, using a swapfile.\n'))
+    if device is None:
+        device = '/swapfile-fabgis'
+        sudo('fallocate -l %sM %s' % (gap, device))
+        sudo('chmod 600 %s' % device)
+        sudo('mkswap %s' % device)
+        sudo('swapon %s' % device)
+    fastprint(blue(
+        '%s needs about %s MB but only %s MB is available - added %s MB '
+        'of swap at %s\n' % (project, needed, available, gap, device)))
+
+    # Sample the swap use in the background to find its peak. The sampler
+    # is uploaded as a script since fabric's shell escaping mangles quoted
+    # awk programs.
+    peak_file = '/tmp/fabgis-swap-peak'
+    sampler = '/tmp/fabgis-swap-sampler.sh'
+    run('rm -f %s' % peak_file)
+    put(StringIO(SWAP_SAMPLER), sampler, mode=0o755)
+    run('nohup %(sampler)s %(device)s %(peak_file)s > /dev/null 2>&1 & '
+        'echo $! > %(peak_file)s.pid' % {
+            'sampler': sampler,
+            'device': device,
+            'peak_file': peak_file},
+        pty=False)
+    try:
+        yield
+    finally:
+        with settings(warn_only=True), hide('output', 'warnings'):
+            run('kill $(cat %(file)s.pid); rm -f %(file)s.pid' % {
+                'file': peak_file})
+            peak = run('cat %s 2> /dev/null || echo 0' % peak_file)
+            run('rm -f %s %s' % (peak_file, sampler))
+        sudo('swapoff %s' % device)
+        if device.startswith('/dev/zram'):
+            sudo('zramctl --reset %s' % device)
+        else:
+            sudo('rm -f %s' % device)
+        fastprint(blue('Peak use of the %s MB of temporary swap: %s MB\n' % (
+            gap, int(peak.strip() or 0) / 1024)))
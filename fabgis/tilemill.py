@@ -30,7 +30,7 @@ def add_developmentseed_ppa():
 
 
 @task
-def setup_tilemill(proxy_url=None):
+def setup_tilemill(proxy_url=None, bundle=False):
     """Set up tile mill - see http://www.mapbox.com/tilemill/ .
 
     We use a pure node setup as described here:
@@ -44,13 +44,24 @@ def setup_tilemill(proxy_url=None):
         The same proxy will be used for both http and https urls. If ommitted
         no proxy will be used.
     :type proxy_url: str
+
+    :param bundle: Whether to update the checkout from a git bundle made on
+        the control host instead of fetching from github on the remote host
+        - see :func:`fabgis.git.update_git_checkout`.
+    :type bundle: bool
+
+    .. versionchanged:: 0.18.0
+        bundle parameter added.
     """
     # Note raring seems not to be supported yet...
     setup_env()
     repo_alias = 'tilemill'
     print env
     update_git_checkout(
-        env.fg.workspace, 'https://github.com/mapbox/tilemill.git', repo_alias)
+        env.fg.workspace,
+        'https://github.com/mapbox/tilemill.git',
+        repo_alias,
+        bundle=bundle)
     work_path = os.path.join(env.fg.workspace, repo_alias)
     setup_node(
         work_path,
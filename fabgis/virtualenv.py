@@ -13,6 +13,7 @@ from fabtools.require.deb import packages as require_packages
 from fabtools.require.python import virtualenv
 
 from .common import setup_env
+from .downloads import put_tarball
 
 
 @task
@@ -80,7 +81,7 @@ def build_pil(code_path):
     venv = os.path.join(code_path, 'venv')
     with cd(venv):
         run('bin/pip uninstall pil')
-        run('wget -c http://effbot.org/downloads/Imaging-1.1.7.tar.gz')
+        put_tarball('http://effbot.org/downloads/Imaging-1.1.7.tar.gz', venv)
         run('tar xfz Imaging-1.1.7.tar.gz')
         with cd(os.path.join(venv, 'Imaging-1.1.7')):
             sed('setup.py', tcl, tcl_value)